@@ -0,0 +1,154 @@
+# Copyright 2020 Christian Seberino
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import machine
+import numpy
+
+IP        = machine.IP
+WORD_SIZE = machine.WORD_SIZE
+OFFSETS   = numpy.arange(WORD_SIZE)
+SHIFTS    = machine.BYTE_SIZE * (WORD_SIZE - 1 - OFFSETS).astype(numpy.uint32)
+
+def div(x, y):
+        return numpy.where(y, x // numpy.maximum(y, 1), 0).astype(numpy.uint32)
+
+OPS = [numpy.add, numpy.subtract, numpy.multiply, div,
+                                            numpy.bitwise_and, numpy.bitwise_or]
+
+def split(idx, values):
+        if (values == values[0]).all():
+                return [(int(values[0]), idx)]
+        keys, inverse = numpy.unique(values, return_inverse = True)
+
+        return [(int(e), idx[inverse == i]) for i, e in enumerate(keys)]
+
+class Lockstep:
+        def __init__(self, memory, regs):
+                self.regs   = numpy.array(regs, dtype = numpy.uint32)
+                self.regs   = self.regs.reshape(-1, machine.N_REGS)
+                if isinstance(memory, (bytes, bytearray)):
+                        memory = numpy.frombuffer(memory, dtype = numpy.uint8)
+                memory      = numpy.array(memory, dtype = numpy.uint8)
+                if memory.ndim == 1:
+                        memory = numpy.tile(memory, (len(self.regs), 1))
+                self.memory = memory
+                self.steps  = numpy.zeros(len(self.regs), dtype = numpy.int64)
+                self.done   = numpy.zeros(len(self.regs), dtype = bool)
+                self.instrs = {}
+                self.code   = {}
+                self.dirty  = (memory != memory[0]).any(axis = 0)
+                self.dirty  = set(numpy.flatnonzero(self.dirty) // WORD_SIZE)
+
+        def grow(self, end):
+                if end > self.memory.shape[1]:
+                        extra       = ((0, 0), (0, end - self.memory.shape[1]))
+                        self.memory = numpy.pad(self.memory, extra)
+
+        def get_words(self, idx, addrs):
+                addrs = addrs.astype(numpy.int64)
+                self.grow(int(addrs.max()) + WORD_SIZE)
+                bytes_ = self.memory[idx[:, None], addrs[:, None] + OFFSETS]
+                words  = bytes_.astype(numpy.uint32) << SHIFTS
+
+                return numpy.bitwise_or.reduce(words, axis = 1)
+
+        def set_words(self, idx, addrs, words):
+                addrs = addrs.astype(numpy.int64)
+                self.grow(int(addrs.max()) + WORD_SIZE)
+                bytes_ = (words[:, None] >> SHIFTS).astype(numpy.uint8)
+                self.memory[idx[:, None], addrs[:, None] + OFFSETS] = bytes_
+                addrs  = numpy.concatenate((addrs, addrs + WORD_SIZE - 1))
+                self.dirty.update(numpy.unique(addrs // WORD_SIZE).tolist())
+
+        def decode(self, word):
+                if word not in self.instrs:
+                        word              = int(word)
+                        bytes_            = word.to_bytes(WORD_SIZE, "big")
+                        self.instrs[word] = machine.decode(bytes_)
+
+                return self.instrs[word]
+
+        def execute(self, ip, idx, instr):
+                regs                  = self.regs
+                opcode, func, a, b, c = instr
+                if   opcode < len(OPS):
+                        regs[idx, c] = OPS[opcode](regs[idx, a], regs[idx, b])
+                elif opcode == machine.ZJUMP:
+                        jump            = regs[idx, a] == 0
+                        regs[idx, IP]   = numpy.where(jump, regs[idx, b] -
+                                                      WORD_SIZE, regs[idx, IP])
+                elif opcode == machine.GJUMP:
+                        jump            = regs[idx, a] > regs[idx, b]
+                        regs[idx, IP]   = numpy.where(jump, regs[idx, c] -
+                                                      WORD_SIZE, regs[idx, IP])
+                elif opcode == machine.COPY:
+                        regs[idx, b] = a
+                elif opcode == machine.LOAD:
+                        regs[idx, b] = self.get_words(idx, regs[idx, a])
+                elif opcode == machine.STORE:
+                        self.set_words(idx, regs[idx, b], regs[idx, a])
+                elif opcode == machine.STOP:
+                        self.done[idx] = True
+                else:
+                        raise ValueError(f"illegal instruction at {ip:#010x}")
+                regs[idx, IP]   += WORD_SIZE
+                self.steps[idx] += 1
+                if   opcode == machine.STOP:
+                        result = []
+                elif opcode in (machine.ZJUMP, machine.GJUMP) or \
+                                          machine.writes_ip(opcode, a, b, c):
+                        result = split(idx, regs[idx, IP])
+                else:
+                        result = [(ip + WORD_SIZE, idx)]
+
+                return result
+
+        def step(self, ip, idx):
+                self.grow(ip + WORD_SIZE)
+                ends = ip // WORD_SIZE, (ip + WORD_SIZE - 1) // WORD_SIZE
+                if self.dirty.isdisjoint(ends):
+                        if ip not in self.code:
+                                word          = self.memory[idx[0],
+                                                          ip:ip + WORD_SIZE]
+                                self.code[ip] = machine.decode(word.tobytes())
+
+                        return self.execute(ip, idx, self.code[ip])
+                words  = self.memory[idx, ip:ip + WORD_SIZE] << SHIFTS
+                words  = numpy.bitwise_or.reduce(words, axis = 1)
+                result = []
+                for word, group in split(idx, words):
+                        result += self.execute(ip, group, self.decode(word))
+
+                return result
+
+        def run(self, max_steps = None):
+                groups = {}
+                idx    = numpy.flatnonzero(~self.done)
+                if len(idx):
+                        groups = dict(split(idx, self.regs[idx, IP]))
+                while groups:
+                        ip  = min(groups)
+                        idx = groups.pop(ip)
+                        if max_steps is not None:
+                                idx = idx[self.steps[idx] < max_steps]
+                                if not len(idx):
+                                        continue
+                        for ip, idx in self.step(ip, idx):
+                                if ip in groups:
+                                        idx = numpy.concatenate((groups[ip],
+                                                                          idx))
+                                groups[ip] = idx
+
+                return bool(self.done.all())
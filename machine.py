@@ -0,0 +1,617 @@
+# Copyright 2020 Christian Seberino
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import collections
+import struct
+import bisect
+import json
+import math
+import mmap
+import time
+import io
+import os
+
+FUNCS     = ["add", "sub", "mult", "div", "and_", "or_",
+                     "zjump", "gjump", "copy", "load", "store", "stop"]
+N_REGS    = 16
+N_OPS     = 16
+ZJUMP     = FUNCS.index("zjump")
+GJUMP     = FUNCS.index("gjump")
+COPY      = FUNCS.index("copy")
+LOAD      = FUNCS.index("load")
+STORE     = FUNCS.index("store")
+STOP      = FUNCS.index("stop")
+IP        = 0
+BYTE_SIZE = 8
+WORD_SIZE = 4
+MOD_SIZE  = 2 ** (WORD_SIZE * BYTE_SIZE)
+HOT_COUNT = 16
+MAX_BLOCK = 256
+TIME_STEP = 2 ** 16
+PAGE_SIZE = 4096
+ZERO_PAGE = bytes(PAGE_SIZE)
+DUMP_SIZE = 2 ** 16
+ZERO_DUMP = bytes(DUMP_SIZE)
+ZERO_WORD = WORD_SIZE * "00"
+FAULTED   = 1
+LIMITED   = 3
+EXPRS     = ["({} + {}) % " + str(MOD_SIZE),
+             "({} - {}) % " + str(MOD_SIZE),
+             "({} * {}) % " + str(MOD_SIZE),
+             "int({0} / {1}) % " + str(MOD_SIZE) + " if {1} else 0",
+             "{} & {}",
+             "{} | {}"]
+
+class Fault(Exception):
+        pass
+
+class FixedMemory(bytearray):
+        pass
+
+class PagedMemory:
+        def __init__(self, image = b""):
+                self.image = image
+                self.size  = len(image)
+                self.pages = {}
+
+        def __len__(self):
+                return MOD_SIZE
+
+        def __getitem__(self, key):
+                beg, end  = key.start, key.stop
+                page, off = divmod(beg, PAGE_SIZE)
+                if off + end - beg > PAGE_SIZE:
+                        mid = beg - off + PAGE_SIZE
+
+                        return self[beg:mid] + self[mid:end]
+                source = self.pages.get(page)
+                if source is None:
+                        if beg < self.size:
+                                return self.image[beg:end].ljust(end - beg,
+                                                                      b"\x00")
+                        source = ZERO_PAGE
+
+                return source[off:off + end - beg]
+
+        def __setitem__(self, key, value):
+                beg = key.start
+                while value:
+                        page, off = divmod(beg, PAGE_SIZE)
+                        size      = min(len(value), PAGE_SIZE - off)
+                        if page not in self.pages:
+                                image = self.get_image_page(page)
+                                image = image.ljust(PAGE_SIZE, b"\x00")
+                                self.pages[page] = bytearray(image)
+                        self.pages[page][off:off + size] = value[:size]
+                        beg, value = beg + size, value[size:]
+
+        def get_image_page(self, page):
+                return self.image[PAGE_SIZE * page:PAGE_SIZE * (page + 1)]
+
+        def regions(self):
+                result = []
+                pages  = range((self.size + PAGE_SIZE - 1) // PAGE_SIZE)
+                pages  = set(pages) | set(self.pages)
+                for e in sorted(pages):
+                        region = self.pages.get(e) or self.get_image_page(e)
+                        if e in self.pages or any(region):
+                                result.append((PAGE_SIZE * e, region))
+
+                return result
+
+def get_reg_args(word):
+        return word[0] & 0xf, word[1] >> (BYTE_SIZE // 2), word[1] & 0xf
+
+def get_copy_args(word):
+        const = (int.from_bytes(word, "big") & 0x0ffffff0) >> (BYTE_SIZE // 2)
+
+        return const, word[3] & 0xf, 0
+
+def grow(beg, memory):
+        if type(memory) is not bytearray:
+                raise Fault(f"memory access out of range at {beg:#010x}")
+        memory += (beg + WORD_SIZE - len(memory)) * b"\x00"
+
+def get_word(beg, memory):
+        if len(memory) < beg + WORD_SIZE:
+                grow(beg, memory)
+
+        return memory[beg:beg + WORD_SIZE]
+
+def set_word(word, beg, memory):
+        if len(memory) < beg + WORD_SIZE:
+                grow(beg, memory)
+        memory[beg:beg + WORD_SIZE] = word
+
+def exec_add(a, b, c, regs, memory):
+        regs[c] = (regs[a] + regs[b]) % MOD_SIZE
+
+def exec_sub(a, b, c, regs, memory):
+        regs[c] = (regs[a] - regs[b]) % MOD_SIZE
+
+def exec_mult(a, b, c, regs, memory):
+        regs[c] = (regs[a] * regs[b]) % MOD_SIZE
+
+def exec_div(a, b, c, regs, memory):
+        regs[c] = int(regs[a] / regs[b]) % MOD_SIZE if regs[b] else 0
+
+def exec_and_(a, b, c, regs, memory):
+        regs[c] = regs[a] & regs[b]
+
+def exec_or_(a, b, c, regs, memory):
+        regs[c] = regs[a] | regs[b]
+
+def exec_copy(a, b, c, regs, memory):
+        regs[b] = a
+
+def exec_load(a, b, c, regs, memory):
+        regs[b] = int.from_bytes(get_word(regs[a], memory), "big")
+
+def exec_store(a, b, c, regs, memory):
+        set_word(regs[a].to_bytes(WORD_SIZE, "big"), regs[b], memory)
+
+def exec_zjump(a, b, c, regs, memory):
+        if regs[a] == 0:
+                regs[IP] = regs[b] - WORD_SIZE
+
+def exec_gjump(a, b, c, regs, memory):
+        if regs[a] > regs[b]:
+                regs[IP] = regs[c] - WORD_SIZE
+
+def exec_stop( a, b, c, regs, memory):
+        pass
+
+def exec_illegal(a, b, c, regs, memory):
+        raise ValueError(f"illegal instruction at {regs[IP]:#010x}")
+
+EXECS    = [globals()["exec_" + e] for e in FUNCS]
+EXECS    = EXECS + (N_OPS - len(EXECS)) * [exec_illegal]
+GET_ARGS = [get_copy_args if e == "copy" else get_reg_args for e in FUNCS]
+GET_ARGS = GET_ARGS + (N_OPS - len(GET_ARGS)) * [get_reg_args]
+
+def word_func(exec_func, get_args):
+        def func(word, regs, memory):
+                exec_func(*get_args(word), regs, memory)
+
+        return func
+
+for e in FUNCS:
+        globals()[e] = word_func(globals()["exec_" + e],
+                                 GET_ARGS[FUNCS.index(e)])
+
+def decode(word, execs = EXECS):
+        opcode = word[0] >> (BYTE_SIZE // 2)
+
+        return (opcode, execs[opcode]) + GET_ARGS[opcode](word)
+
+def disassemble(word):
+        opcode, func, a, b, c = decode(word)
+        if   opcode >= len(FUNCS):
+                result = ["0x" + word.hex()]
+        elif opcode == COPY:
+                result = [FUNCS[opcode], hex(a), f"r{b}"]
+        elif opcode in (ZJUMP, LOAD, STORE):
+                result = [FUNCS[opcode], f"r{a}", f"r{b}"]
+        elif opcode == STOP:
+                result = [FUNCS[opcode]]
+        else:
+                result = [FUNCS[opcode].rstrip("_"), f"r{a}", f"r{b}", f"r{c}"]
+
+        return " ".join(result)
+
+def get_used_regs(opcode, a, b, c):
+        if   opcode == COPY:
+                result = {b}
+        elif opcode in (ZJUMP, LOAD, STORE):
+                result = {a, b}
+        else:
+                result = {a, b, c}
+
+        return result - {IP}
+
+def writes_ip(opcode, a, b, c):
+        if opcode < len(EXPRS):
+                result = c == IP
+        else:
+                result = opcode in (COPY, LOAD) and b == IP
+
+        return result
+
+def block_source(beg, block):
+        regs  = set()
+        for opcode, func, a, b, c in block:
+                regs |= get_used_regs(opcode, a, b, c)
+        load  = [f"r{e} = regs[{e}]" for e in sorted(regs)]
+        save  = [f"regs[{e}] = r{e}" for e in sorted(regs)]
+        body  = []
+        for i, (opcode, func, a, b, c) in enumerate(block):
+                ip    = beg + i * WORD_SIZE
+                val   = lambda r : str(ip) if r == IP else f"r{r}"
+                next_ = ip + WORD_SIZE
+                if   opcode < len(EXPRS):
+                        dest, expr = c, EXPRS[opcode].format(val(a), val(b))
+                elif opcode == COPY:
+                        dest, expr = b, str(a)
+                elif opcode == LOAD:
+                        body.append(f"pc = {ip}")
+                        dest, expr = b, f"get_word({val(a)}, memory)"
+                        expr       = f"int.from_bytes({expr}, 'big')"
+                elif opcode == STORE:
+                        word = f"({val(a)}).to_bytes({WORD_SIZE}, 'big')"
+                        body.append(f"pc = {ip}")
+                        body.append(f"set_word({word}, {val(b)}, memory)")
+                        body.append(f"if invalidate({val(b)}):")
+                        body.extend(8 * " " + e for e in save +
+                                 [f"regs[{IP}] = {next_}", f"return {i + 1}"])
+                        continue
+                elif opcode == ZJUMP:
+                        next_ = f"{val(b)} if {val(a)} == 0 else {next_}"
+                        continue
+                elif opcode == GJUMP:
+                        next_ = f"{val(c)} if {val(a)} > {val(b)} else {next_}"
+                        continue
+                if dest == IP:
+                        body.append(f"ip = {expr}")
+                        next_ = f"ip + {WORD_SIZE}"
+                else:
+                        body.append(f"r{dest} = {expr}")
+        body += save + [f"regs[{IP}] = {next_}", f"return {len(block)}"]
+        if any(e.startswith("pc = ") for e in body):
+                body  = ["try:"] + [8 * " " + e for e in body]
+                body += ["except Fault:"] + [8 * " " + e for e in save +
+                                                [f"regs[{IP}] = pc", "raise"]]
+
+        return "def block(regs, memory):\n" + "\n".join(8 * " " + e
+                                                         for e in load + body)
+
+def get_regions(memory):
+        if isinstance(memory, PagedMemory):
+                return memory.regions()
+
+        return [(0, memory)]
+
+def dump_profile(op_counts, ip_counts, memory, out, labels = None,
+                                             source_map = None, n_lines = 20):
+        total  = sum(op_counts.values()) or 1
+        places = sorted((labels or {}).items(),
+                                  key = lambda e : (e[1], e[0][0] != "_"))
+        names  = [e[0] for e in places]
+        addrs  = [e[1] for e in places]
+        out.write(b"opcodes:\n\n")
+        for opcode, count in op_counts.most_common():
+                name  = FUNCS[opcode].rstrip("_")
+                line  = f"\t{name:<8} {count:>14,} {100 * count / total:>6.1f}%"
+                out.write((line + "\n").encode())
+        out.write(b"\nhot spots:\n\n")
+        for ip, count in ip_counts.most_common(n_lines):
+                place = ""
+                i     = bisect.bisect(addrs, ip) - 1
+                if i >= 0:
+                        place = names[i] + (f"+{ip - addrs[i]}" if ip >
+                                                               addrs[i] else "")
+                instr = disassemble(get_word(ip, memory))
+                line  = f"\t{ip:#010x}  {place:<20} {count:>14,} " \
+                                   f"{100 * count / total:>6.1f}%  {instr}"
+                out.write((line + "\n").encode())
+        if source_map:
+                sources = {e[0] : tuple(e[1:]) for e in source_map}
+                counts  = collections.Counter()
+                for ip, count in ip_counts.items():
+                        if ip in sources:
+                                counts[sources[ip]] += count
+                out.write(b"\nsource lines:\n\n")
+                for (number, label, macro), count in \
+                                                 counts.most_common(n_lines):
+                        line = f"\tline {number:<6} {label or '':<20} " \
+                               f"{macro or '':<10} {count:>14,} " \
+                               f"{100 * count / total:>6.1f}%"
+                        out.write((line + "\n").encode())
+
+def dump_regs(regs, out):
+        out.write(b"registers:\n\n")
+        for i in range(N_REGS):
+                reg = "\t{:>3}".format("r" + str(i)) + f": {regs[i]:#010x}\n"
+                out.write(reg.encode())
+
+def dump_memory(memory, out, squeeze = False):
+        out.write(b"\nmemory:\n\n")
+        for beg, region in get_regions(memory):
+                view  = memoryview(region)
+                zeros = 0
+                for off in range(0, len(view), DUMP_SIZE):
+                        chunk = view[off:off + DUMP_SIZE]
+                        if zeros > 1 and chunk == ZERO_DUMP[:len(chunk)]:
+                                continue
+                        hex_  = chunk.hex()
+                        lines = []
+                        for i in range(0, len(hex_), 2 * WORD_SIZE):
+                                word = hex_[i:i + 2 * WORD_SIZE]
+                                if squeeze and word == ZERO_WORD:
+                                        zeros += 1
+                                        if zeros == 2:
+                                                lines.append("\t*\n")
+                                        if zeros > 1:
+                                                continue
+                                else:
+                                        zeros  = 0
+                                addr = beg + off + i // 2
+                                lines.append(f"\t{addr:#010x}: 0x{word:0<8}\n")
+                        out.write("".join(lines).encode())
+
+def write_memory(memory, out, sparse = True):
+        end = 0
+        for beg, region in get_regions(memory):
+                if sparse:
+                        out.seek(beg)
+                        end = beg
+                while end < beg:
+                        out.write(ZERO_DUMP[:min(DUMP_SIZE, beg - end)])
+                        end += min(DUMP_SIZE, beg - end)
+                out.write(region)
+                end = beg + len(region)
+
+def get_nonzero_ranges(memory):
+        result = []
+        for beg, region in get_regions(memory):
+                view  = memoryview(region)
+                start = None
+                off   = 0
+                while off < len(view):
+                        if start is None and off % DUMP_SIZE == 0:
+                                chunk = view[off:off + DUMP_SIZE]
+                                if chunk == ZERO_DUMP[:len(chunk)]:
+                                        off += DUMP_SIZE
+                                        continue
+                        if   any(view[off:off + WORD_SIZE]):
+                                start = off if start is None else start
+                        elif start is not None:
+                                result.append((beg + start, view[start:off]))
+                                start = None
+                        off += WORD_SIZE
+                if start is not None:
+                        result.append((beg + start, view[start:]))
+
+        return result
+
+def dump_json(regs, memory, out):
+        ranges = [{"address" : beg, "data" : e.hex()}
+                                     for beg, e in get_nonzero_ranges(memory)]
+        state  = {"registers" : regs, "memory" : ranges}
+        out.write((json.dumps(state) + "\n").encode())
+
+def pack_regs(regs):
+        return struct.pack(f">{N_REGS}I", *[e % MOD_SIZE for e in regs])
+
+def write_state(regs, memory, out, format_ = "text", squeeze = False):
+        if   format_ == "raw":
+                write_memory(memory, out, False)
+        elif format_ == "json":
+                dump_json(regs, memory, out)
+        elif format_ == "regs":
+                out.write(pack_regs(regs))
+        else:
+                dump_regs(regs, out)
+                dump_memory(memory, out, squeeze)
+
+def load_memory(path, size = None, paged = False, mapped = False):
+        with open(path, "rb") as f:
+                if mapped and os.fstat(f.fileno()).st_size:
+                        image = mmap.mmap(f.fileno(), 0,
+                                                    access = mmap.ACCESS_COPY)
+                else:
+                        image = f.read()
+        if   size is not None:
+                if len(image) > size:
+                        raise ValueError("image is larger than the memory size")
+                memory = FixedMemory(image.ljust(size, b"\x00"))
+        elif paged or mapped:
+                memory = PagedMemory(image)
+        else:
+                memory = bytearray(image)
+
+        return memory
+
+class Machine:
+        def __init__(self, memory = None, regs = None):
+                self.memory    = bytearray() if memory is None else memory
+                self.regs      = N_REGS * [0] if regs is None else regs
+                self.steps     = 0
+                self.cache     = {}
+                self.blocks    = {}
+                self.covers    = {}
+                self.heat      = {}
+                self.op_counts = collections.Counter()
+                self.ip_counts = collections.Counter()
+                self.execs     = EXECS[:STORE] + [self.store] + \
+                                                           EXECS[STORE + 1:]
+                self.globals   = {"get_word"   : get_word,
+                                  "set_word"   : set_word,
+                                  "invalidate" : self.invalidate,
+                                  "Fault"      : Fault}
+
+        def store(self, a, b, c, regs, memory):
+                exec_store(a, b, c, regs, memory)
+                self.invalidate(regs[b])
+
+        def invalidate(self, beg):
+                cache, blocks, covers = self.cache, self.blocks, self.covers
+                result                = False
+                for e in range(beg - beg % WORD_SIZE, beg + WORD_SIZE,
+                                                                    WORD_SIZE):
+                        cache.pop(e, None)
+                        if e in covers:
+                                for entry in covers.pop(e):
+                                        result = blocks.pop(entry,
+                                                              None) or result
+
+                return bool(result)
+
+        def fetch(self, beg):
+                instr = decode(get_word(beg, self.memory), self.execs)
+                if beg % WORD_SIZE == 0:
+                        self.cache[beg] = instr
+
+                return instr
+
+        def step(self):
+                ip                    = self.regs[IP]
+                opcode, func, a, b, c = self.cache.get(ip) or self.fetch(ip)
+                func(a, b, c, self.regs, self.memory)
+                self.regs[IP] += WORD_SIZE
+                self.steps    += 1
+
+                return opcode
+
+        def interpret(self, regs, memory):
+                n_instrs = 0
+                while n_instrs < MAX_BLOCK:
+                        ip                    = regs[IP]
+                        opcode, func, a, b, c = self.cache.get(ip) or \
+                                                                 self.fetch(ip)
+                        if opcode == STOP:
+                                if n_instrs:
+                                        break
+                                regs[IP] += WORD_SIZE
+
+                                return 0
+                        func(a, b, c, regs, memory)
+                        regs[IP] += WORD_SIZE
+                        n_instrs += 1
+                        if opcode in (ZJUMP, GJUMP) or \
+                                                  regs[IP] != ip + WORD_SIZE:
+                                break
+
+                return n_instrs
+
+        def get_block(self, beg):
+                block = []
+                while len(block) < MAX_BLOCK:
+                        ip = beg + len(block) * WORD_SIZE
+                        try:
+                                instr = self.cache.get(ip) or self.fetch(ip)
+                        except Fault:
+                                break
+                        if instr[0] >= STOP:
+                                break
+                        block.append(instr)
+                        opcode, func, a, b, c = instr
+                        if opcode in (ZJUMP, GJUMP) or \
+                                                   writes_ip(opcode, a, b, c):
+                                break
+
+                return block
+
+        def translate(self, beg):
+                self.heat[beg] = self.heat.get(beg, 0) + 1
+                if self.heat[beg] < HOT_COUNT or beg % WORD_SIZE:
+                        return self.interpret
+                block = self.get_block(beg)
+                if not block:
+                        return self.interpret
+                namespace = {}
+                exec(block_source(beg, block), self.globals, namespace)
+                self.blocks[beg] = namespace["block"]
+                for e in range(beg, beg + len(block) * WORD_SIZE, WORD_SIZE):
+                        self.covers.setdefault(e, []).append(beg)
+
+                return self.blocks[beg]
+
+        def profile(self, max_steps = None, timeout = None):
+                regs, memory, cache  = self.regs, self.memory, self.cache
+                op_counts, ip_counts = self.op_counts, self.ip_counts
+                fetch     = self.fetch
+                steps     = self.steps
+                end       = math.inf if max_steps is None else steps + max_steps
+                check     = math.inf if timeout   is None else TIME_STEP
+                if timeout is not None:
+                        deadline = time.monotonic() + timeout
+                try:
+                        while steps < end:
+                                last = min(end, steps + check)
+                                while steps < last:
+                                        ip                    = regs[IP]
+                                        opcode, func, a, b, c = \
+                                                  cache.get(ip) or fetch(ip)
+                                        func(a, b, c, regs, memory)
+                                        regs[IP]          += WORD_SIZE
+                                        steps             += 1
+                                        op_counts[opcode] += 1
+                                        ip_counts[ip]     += 1
+                                        if opcode == STOP:
+                                                return True
+                                if timeout is not None and \
+                                                   time.monotonic() > deadline:
+                                        return False
+                finally:
+                        self.steps = steps
+
+                return False
+
+        def run(self, max_steps = None, timeout = None):
+                regs, memory, blocks = self.regs, self.memory, self.blocks
+                translate = self.translate
+                steps     = self.steps
+                end       = math.inf if max_steps is None else steps + max_steps
+                check     = math.inf if timeout   is None else TIME_STEP
+                if timeout is not None:
+                        deadline = time.monotonic() + timeout
+                try:
+                        while steps <= end - MAX_BLOCK:
+                                last = min(end - MAX_BLOCK, steps + check)
+                                while steps <= last:
+                                        ip       = regs[IP]
+                                        block    = blocks.get(ip) or \
+                                                                  translate(ip)
+                                        n_instrs = block(regs, memory)
+                                        steps   += n_instrs or 1
+                                        if not n_instrs:
+                                                return True
+                                if timeout is not None and \
+                                                   time.monotonic() > deadline:
+                                        return False
+                finally:
+                        self.steps = steps
+                while self.steps < end:
+                        if self.step() == STOP:
+                                return True
+
+                return False
+
+def run_image(path, size = None, paged = False, mapped = False,
+                             format_ = "text", squeeze = False,
+                             max_steps = None, timeout = None):
+        out    = io.BytesIO()
+        status = 0
+        error  = None
+        try:
+                computer = Machine(load_memory(path, size, paged, mapped))
+                try:
+                        if not computer.run(max_steps, timeout):
+                                status = LIMITED
+                                error  = f"limit: stopped after " \
+                                                     f"{computer.steps} steps"
+                except Fault as fault:
+                        status = FAULTED
+                        error  = f"fault: {fault}"
+                except ValueError as value_error:
+                        status = FAULTED
+                        error  = f"error: {value_error}"
+                write_state(computer.regs, computer.memory, out, format_,
+                                                                       squeeze)
+        except (OSError, ValueError) as load_error:
+                status = FAULTED
+                error  = f"error: {load_error}"
+
+        return path, status, error, out.getvalue()
@@ -13,11 +13,14 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import functools
+import threading
+import math
 import re
 
 REG       = r"r1[0-5]|r[0-9]"
 NAT       = r"0x[0-9a-f]+|\d+"
-R_AND_N   = f"({REG})[+-]({NAT})"
+R_AND_N   = f"(?P<base>{REG})(?P<sign>[+-])(?P<offset>{NAT})"
 LABEL     = r"\w+"
 STACK_PTR = "r1"
 RET_PTR   = "r2"
@@ -29,49 +32,125 @@ BYTE_LEN  = 8
 WORD_LEN  = 4
 SECOND    = (STACK_PTR,     WORD_LEN)
 THIRD     = (STACK_PTR, 2 * WORD_LEN)
-NIBB_MASK = 2 ** (WORD_LEN * BYTE_LEN // 2) - 1
+CONST_LEN = 3
+CONST_MAX = 2 ** (CONST_LEN * BYTE_LEN) - 1
+WORD_BITS = WORD_LEN * BYTE_LEN
 SIGN_MASK = 1 << (WORD_LEN * BYTE_LEN -  1)
 NEG_ONE   = 0xffffffff
 HEXADEC   = 16
-
-labels     = []
-if_labs    = []
-while_labs = []
-
-def parse_arg(arg):
-        result = None
-        if   re.fullmatch(REG, arg):
+LABEL_RE  = re.compile(f"({LABEL}):")
+REG_RE    = re.compile(rf"\b(?:{REG})\b")
+TOKEN_RE  = re.compile(f"(?P<reg>{REG})|(?P<nat>{NAT})|{R_AND_N}|{LABEL}")
+TOKEN_MAX = 2 ** 12
+FREE_REGS = [f"r{e}" for e in range(8, 16)]
+
+class Labels:
+        def __init__(self, names = ()):
+                self.names = set(names)
+                self.count = 0
+
+        def add(self, name):
+                self.names.add(name)
+
+        def new(self):
+                self.count += 1
+                while f"_unique_{self.count}" in self.names:
+                        self.count += 1
+                self.names.add(f"_unique_{self.count}")
+
+                return [f"_unique_{self.count}"]
+
+class Expander:
+        def __init__(self, spill_regs = True, short_labels = True):
+                self.spill_regs   = spill_regs
+                self.short_labels = short_labels
+                self.labels       = Labels()
+                self.if_labs      = []
+                self.while_labs   = []
+                self.free         = []
+                self.spills       = []
+
+        def new_label(self):
+                return self.labels.new()
+
+        def iter_lines(self, lines, names = (), regs = FREE_REGS):
+                self.labels     = Labels(names)
+                self.if_labs    = []
+                self.while_labs = []
+                self.free       = [e for e in FREE_REGS if e not in regs]
+                self.free       = self.free if self.spill_regs else []
+                self.spills     = []
+                for i, e in enumerate(lines):
+                        if not e.split():
+                                continue
+                        label, e_, macro = split_line(e)
+                        name             = label[:label.find(":")]
+                        orig             = current()
+                        local.expander   = self
+                        try:
+                                result = expand(label, e_, macro)
+                        finally:
+                                local.expander = orig
+                        for line_ in result:
+                                yield line_, i + 1, name or None, macro
+
+        def replace_lines(self, asm):
+                lines = asm.split("\n")
+
+                return list(self.iter_lines(lines, *scan(lines)))
+
+        def replace(self, asm):
+                return "".join([e[0] for e in self.replace_lines(asm)])
+
+local = threading.local()
+
+def current():
+        if not hasattr(local, "expander"):
+                local.expander = Expander()
+
+        return local.expander
+
+def get_nat(nat):
+        return int(nat, HEXADEC) if nat.startswith("0x") else int(nat)
+
+@functools.lru_cache(maxsize = TOKEN_MAX)
+def get_token(arg):
+        match = TOKEN_RE.fullmatch(arg)
+        if   match is None:
+                result = None
+        elif match["reg"]:
                 result = arg
-        elif re.fullmatch(NAT, arg):
-                if arg.startswith("0x"):
-                        result = int(arg, HEXADEC)
-                else:
-                        result = int(arg)
-        elif re.fullmatch(R_AND_N, arg):
-                reg = re.match(REG, arg).group(0)
-                nat = arg[len(reg) + 1:]
-                if nat.startswith("0x"):
-                        nat = int(nat, HEXADEC)
-                else:
-                        nat = int(nat)
-                if arg[len(reg)] == "-":
-                        nat *= -1
-                result = (reg, nat)
-        elif re.fullmatch(LABEL, arg):
+        elif match["nat"]:
+                result = get_nat(arg)
+        elif match["base"]:
+                result = get_nat(match["offset"])
+                result = -result if match["sign"] == "-" else result
+                result = (match["base"], result)
+        else:
                 result = [arg]
 
         return result
 
+def parse_arg(arg):
+        result = get_token(arg)
+
+        return result[:] if isinstance(result, list) else result
+
 def parse_args(args):
-        result = []
-        index  = 0
-        while index < len(args):
-                if (index <= len(args) - 3) and (args[index + 1] in ["+", "-"]):
-                        result.append(parse_arg("".join(args[index:index + 3])))
-                        index += 3
-                else:
-                        result.append(parse_arg(args[index]))
-                        index += 1
+        if "+" not in args and "-" not in args:
+                result = [parse_arg(e) for e in args]
+        else:
+                result = []
+                index  = 0
+                while index < len(args):
+                        if (index <= len(args) - 3) and \
+                                                (args[index + 1] in ["+", "-"]):
+                                arg    = "".join(args[index:index + 3])
+                                index += 3
+                        else:
+                                arg    = args[index]
+                                index += 1
+                        result.append(parse_arg(arg))
 
         return result
 
@@ -83,42 +162,64 @@ def line(func, *args):
 
         return line_
 
-def new_label_gen():
-        count = 1
-        label = f"_unique_{count}"
-        while True:
-                while label in labels:
-                        count += 1
-                        label  = f"_unique_{count}"
-                labels.append(label)
-                yield [label]
-new_label = lambda : next(new_label_gen())
-
-def replace_(asm):
-        result = ""
-        for e in [e for e in asm.strip().split("\n") if e]:
-                e_    = e.split()
-                label = e_[0] if ":" in e_[0] else ""
-                if label:
-                        e_      = e_[1:]
-                if (e_[0] == e_[0].upper()) and (e_[0] in globals()):
-                        args    = parse_args(e_[1:])
-                        result += label.ljust(SECT_LEN) + NOTH()[SECT_LEN:]
-                        result += globals()[e_[0]](*args)
+new_label = lambda : current().new_label()
+
+def split_line(line_):
+        e_    = line_.split()
+        label = e_[0] if ":" in e_[0] else ""
+        e_    = e_[1:] if label else e_
+        macro = e_[0] if (e_[0] == e_[0].upper()) and \
+                                               (e_[0] in globals()) else None
+
+        return label, e_, macro
+
+def expand(label, e_, macro):
+        if macro is None:
+                return [label.ljust(SECT_LEN) + line(*e_)[SECT_LEN:]]
+        result = [label.ljust(SECT_LEN) + NOTH()[SECT_LEN:]]
+        for e in globals()[macro](*parse_args(e_[1:])).splitlines(True):
+                label_, e_, macro_ = split_line(e)
+                if macro_ is None:
+                        result.append(e)
                 else:
-                        result += label.ljust(SECT_LEN) + line(*e_)[SECT_LEN:]
+                        result.extend(expand(label_, e_, macro_))
 
         return result
 
+def scan(lines):
+        names = []
+        regs  = set()
+        for e in lines:
+                match  = LABEL_RE.match(e)
+                names += [match.group(1)] if match else []
+                regs.update(REG_RE.findall(e))
+
+        return names, regs
+
+def replace_lines(asm):
+        return Expander().replace_lines(asm)
+
 def replace(asm):
-        labels.extend(re.findall(f"^{LABEL}:", asm, re.MULTILINE))
-        result = asm
-        orig   = ""
-        while result != orig:
-                orig   = result
-                result = replace_(orig)
+        return Expander().replace(asm)
 
-        return result
+def push(arg_1):
+        expander = current()
+        reg      = expander.free.pop() if expander.free else None
+        expander.spills.append(reg)
+
+        return PUSH(arg_1) if reg is None else COPY(arg_1, reg)
+
+def pop(arg_1):
+        expander = current()
+        reg      = expander.spills.pop()
+        if reg is not None:
+                expander.free.append(reg)
+
+        return POP(arg_1) if reg is None else \
+                                     COPY(reg, arg_1) + line("copy", 0, reg)
+
+def is_work(arg):
+        return (arg[0] if isinstance(arg, tuple) else arg) in WORK
 
 def NOTH():
         return line("and", "r1", "r1", "r1")
@@ -154,40 +255,76 @@ for e in ["ADD", "SUB", "MULT", "AND", "OR"]:
 UDIV = arith_log_macro("div")
 
 def MOD(arg_1, arg_2, arg_3):
-        result  = PUSH(arg_1)
-        result += PUSH(arg_2)
-        result += UDIV(arg_1,   arg_2, arg_3)
-        result += POP(WORK[3])
-        result += MULT(WORK[3], arg_3, arg_3)
-        result += POP(WORK[3])
-        result += SUB(WORK[3],  arg_3, arg_3)
+        if   isinstance(arg_1, int) and isinstance(arg_2, int):
+                result  = COPY((arg_1 & NEG_ONE) % arg_2 if arg_2 else arg_1,
+                                                                         arg_3)
+        elif isinstance(arg_2, int) and arg_2 and not arg_2 & (arg_2 - 1):
+                result  = AND(arg_1,    arg_2 - 1, arg_3)
+        elif isinstance(arg_2, int) and not is_work(arg_1):
+                result  = UDIV(arg_1,   arg_2,     WORK[3])
+                result += MULT(WORK[3], arg_2,     WORK[3])
+                result += SUB(arg_1,    WORK[3],   arg_3)
+        else:
+                result  = push(arg_1)
+                result += push(arg_2)
+                result += UDIV(arg_1,   arg_2, arg_3)
+                result += pop(WORK[3])
+                result += MULT(WORK[3], arg_3, arg_3)
+                result += pop(WORK[3])
+                result += SUB(WORK[3],  arg_3, arg_3)
 
         return result
 
 def UEXP(arg_1, arg_2, arg_3):
-        result  = PUSH(arg_2)
-        result += PUSH(arg_1)
-        result += COPY(1,        arg_3)
-        result += LOAD(SECOND,   WORK[3])
-        result += WHILE(WORK[3])
-        result += AND(WORK[3],   1,       WORK[3])
-        result += IF(WORK[3])
-        result += POP(WORK[3])
-        result += MULT(arg_3,    WORK[3], arg_3)
-        result += PUSH(WORK[3])
-        result += ENDIF()
-        result += LOAD(SECOND,   WORK[3])
-        result += PUSH(arg_3)
-        result += UDIV(WORK[3],  2,       arg_3)
-        result += STORE(arg_3,   THIRD)
-        result += POP(arg_3)
-        result += POP(WORK[3])
-        result += MULT(WORK[3],  WORK[3], WORK[3])
-        result += PUSH(WORK[3])
-        result += LOAD(SECOND,   WORK[3])
-        result += ENDWHILE()
-        result += POP(WORK[3])
-        result += POP(WORK[3])
+        if   isinstance(arg_1, int) and isinstance(arg_2, int):
+                result  = COPY(pow(arg_1, arg_2, NEG_ONE + 1), arg_3)
+        elif isinstance(arg_2, int) and arg_3 != WORK[3]:
+                result  = COPY(arg_1,   WORK[3])
+                result += COPY(WORK[3], arg_3) if arg_2 else COPY(1, arg_3)
+                for e in bin(arg_2)[3:]:
+                        result += line("mult", arg_3, arg_3,   arg_3)
+                        if e == "1":
+                                result += line("mult", arg_3, WORK[3], arg_3)
+        elif len(current().free) >= 2:
+                result  = push(arg_2)
+                result += push(arg_1)
+                exp_    = current().spills[-2]
+                base    = current().spills[-1]
+                result += COPY(1,        arg_3)
+                result += WHILE(exp_)
+                result += AND(exp_,      1,       WORK[3])
+                result += IF(WORK[3])
+                result += MULT(arg_3,    base,    arg_3)
+                result += ENDIF()
+                result += UDIV(exp_,     2,       exp_)
+                result += MULT(base,     base,    base)
+                result += ENDWHILE()
+                result += pop(WORK[3])
+                result += pop(WORK[3])
+        else:
+                result  = PUSH(arg_2)
+                result += PUSH(arg_1)
+                result += COPY(1,        arg_3)
+                result += LOAD(SECOND,   WORK[3])
+                result += WHILE(WORK[3])
+                result += AND(WORK[3],   1,       WORK[3])
+                result += IF(WORK[3])
+                result += POP(WORK[3])
+                result += MULT(arg_3,    WORK[3], arg_3)
+                result += PUSH(WORK[3])
+                result += ENDIF()
+                result += LOAD(SECOND,   WORK[3])
+                result += PUSH(arg_3)
+                result += UDIV(WORK[3],  2,       arg_3)
+                result += STORE(arg_3,   THIRD)
+                result += POP(arg_3)
+                result += POP(WORK[3])
+                result += MULT(WORK[3],  WORK[3], WORK[3])
+                result += PUSH(WORK[3])
+                result += LOAD(SECOND,   WORK[3])
+                result += ENDWHILE()
+                result += POP(WORK[3])
+                result += POP(WORK[3])
 
         return result
 
@@ -200,34 +337,50 @@ def NOT(arg_1, arg_2):
 
 def XOR(arg_1, arg_2, arg_3):
         result  = OR(arg_1,     arg_2,   WORK[3])
-        result += PUSH(WORK[3])
+        result += push(WORK[3])
         result += NOT(arg_1,    WORK[3])
         result += NOT(arg_2,    arg_3)
         result += OR(WORK[3],   arg_3,   WORK[3])
-        result += POP(arg_3)
+        result += pop(arg_3)
         result += AND(arg_3,    WORK[3], arg_3)
 
         return result
 
 def LSHIFT(arg_1, arg_2, arg_3):
-        result  = COPY(arg_1,   WORK[3])
-        result += COPY(arg_2,   arg_3)
-        result += WHILE(arg_3)
-        result += MULT(WORK[3], 2,       WORK[3])
-        result += SUB(arg_3,    1,       arg_3)
-        result += ENDWHILE()
-        result += COPY(WORK[3], arg_3)
+        if   isinstance(arg_1, int) and isinstance(arg_2, int):
+                result  = COPY((arg_1 & NEG_ONE) << min(arg_2, WORD_BITS) &
+                                                                NEG_ONE, arg_3)
+        elif isinstance(arg_2, int) and arg_2 >= WORD_BITS:
+                result  = COPY(0,       arg_3)
+        elif isinstance(arg_2, int):
+                result  = MULT(arg_1,   1 << arg_2, arg_3)
+        else:
+                result  = COPY(arg_1,   WORK[3])
+                result += COPY(arg_2,   arg_3)
+                result += WHILE(arg_3)
+                result += MULT(WORK[3], 2,       WORK[3])
+                result += SUB(arg_3,    1,       arg_3)
+                result += ENDWHILE()
+                result += COPY(WORK[3], arg_3)
 
         return result
 
 def RSHIFT(arg_1, arg_2, arg_3):
-        result  = COPY(arg_1,   WORK[3])
-        result += COPY(arg_2,   arg_3)
-        result += WHILE(arg_3)
-        result += UDIV(WORK[3], 2,       WORK[3])
-        result += SUB(arg_3,    1,       arg_3)
-        result += ENDWHILE()
-        result += COPY(WORK[3], arg_3)
+        if   isinstance(arg_1, int) and isinstance(arg_2, int):
+                result  = COPY((arg_1 & NEG_ONE) >> min(arg_2, WORD_BITS) &
+                                                                NEG_ONE, arg_3)
+        elif isinstance(arg_2, int) and arg_2 >= WORD_BITS:
+                result  = COPY(0,       arg_3)
+        elif isinstance(arg_2, int):
+                result  = UDIV(arg_1,   1 << arg_2, arg_3)
+        else:
+                result  = COPY(arg_1,   WORK[3])
+                result += COPY(arg_2,   arg_3)
+                result += WHILE(arg_3)
+                result += UDIV(WORK[3], 2,       WORK[3])
+                result += SUB(arg_3,    1,       arg_3)
+                result += ENDWHILE()
+                result += COPY(WORK[3], arg_3)
 
         return result
 
@@ -267,12 +420,13 @@ def ZJUMP(arg_1, arg_2):
         return result
 
 def NZJUMP(arg_1, arg_2):
+        label   = new_label()
         result  = COPY(arg_1,       WORK[2])
-        result += COPY(new_label(), WORK[3])
+        result += COPY(label,       WORK[3])
         result += line("zjump",     WORK[2], WORK[3])
         result += COPY(arg_2,       WORK[2])
         result += JUMP(WORK[2])
-        result += (labels[-1] + ":").ljust(SECT_LEN) + NOTH()[SECT_LEN:]
+        result += (label[0] + ":").ljust(SECT_LEN) + NOTH()[SECT_LEN:]
 
         return result
 
@@ -284,42 +438,54 @@ def EJUMP(arg_1, arg_2, arg_3):
         return result
 
 def NEJUMP(arg_1, arg_2, arg_3):
+        label   = new_label()
         result  = SUB(arg_1,        arg_2,   WORK[3])
-        result += COPY(new_label(), WORK[2])
+        result += COPY(label,       WORK[2])
         result += line("zjump",     WORK[3], WORK[2])
         result += COPY(arg_3,       WORK[3])
         result += JUMP(WORK[3])
-        result += (labels[-1] + ":").ljust(SECT_LEN) + NOTH()[SECT_LEN:]
+        result += (label[0] + ":").ljust(SECT_LEN) + NOTH()[SECT_LEN:]
 
         return result
 
 def COPY(arg_1, arg_2):
+        work = WORK[1] if arg_2 == WORK[0] else WORK[0]
         if   isinstance(arg_1, str):
                 result  = line("and",   arg_1,         arg_1,   arg_2)
         elif isinstance(arg_1, int):
-                lsb     = arg_1  & NIBB_MASK
-                msb     = arg_1 >> (WORD_LEN * BYTE_LEN // 2)
-                result  = line("copy",  lsb,           arg_2)
-                result += line("copy",  msb,           WORK[0])
-                result += line("copy",  NIBB_MASK + 1, WORK[1])
-                result += line("mult",  WORK[0],       WORK[1], WORK[0])
-                result += line("add",   arg_2,         WORK[0], arg_2)
+                arg_1  &= NEG_ONE
+                root    = math.isqrt(arg_1)
+                if   arg_1 <= CONST_MAX:
+                        result  = line("copy", arg_1,          arg_2)
+                elif arg_1 == root ** 2:
+                        result  = line("copy", root,           arg_2)
+                        result += line("mult", arg_2,          arg_2, arg_2)
+                elif arg_1 % 2 == 0 and arg_1 // 2 <= CONST_MAX:
+                        result  = line("copy", arg_1 // 2,     arg_2)
+                        result += line("add",  arg_2,          arg_2, arg_2)
+                elif arg_1 > NEG_ONE - CONST_MAX:
+                        result  = line("copy", NEG_ONE - arg_1 + 1, arg_2)
+                        result += line("copy", 0,              work)
+                        result += line("sub",  work,           arg_2, arg_2)
+                else:
+                        result  = line("copy", root,           arg_2)
+                        result += line("mult", arg_2,          arg_2, arg_2)
+                        result += line("copy", arg_1 - root ** 2, work)
+                        result += line("add",  arg_2,          work,  arg_2)
         elif isinstance(arg_1, tuple):
                 result  = COPY(abs(arg_1[1]), arg_2)
                 if arg_1[1] >= 0:
                         result += line("add", arg_1[0], arg_2, arg_2)
                 else:
                         result += line("sub", arg_1[0], arg_2, arg_2)
+        elif isinstance(arg_1, list) and current().short_labels:
+                result  = line("copy",  arg_1[0],      arg_2)
         elif isinstance(arg_1, list):
-                result  = line("and",   "r0",          "r0",    arg_2)
-                result += line("copy",  "32",          WORK[0])
-                result += line("copy",  "4",           WORK[1])
-                result += line("add",   arg_2,         WORK[0], WORK[0])
-                result += line("add",   WORK[0],       WORK[1], WORK[1])
-                result += line("load",  WORK[0],       arg_2)
-                result += line("copy",  "0",           WORK[0])
-                result += line("zjump", WORK[0],       WORK[1])
+                result  = line("copy",  2 * WORD_LEN,  work)
+                result += line("add",   "r0",          work,    arg_2)
+                result += line("and",   arg_2,         arg_2,   "r0")
                 result += line(arg_1[0])
+                result += line("load",  arg_2,         arg_2)
 
         return result
 
@@ -350,11 +516,12 @@ def POP(arg_1):
         return result
 
 def CALL(*args):
-        result  = PUSH(new_label())
+        label   = new_label()
+        result  = PUSH(label)
         for e in reversed(args[1:]):
                 result += PUSH(e)
         result += JUMP(args[0])
-        result += (labels[-1] + ":").ljust(SECT_LEN) + NOTH()[SECT_LEN:]
+        result += (label[0] + ":").ljust(SECT_LEN) + NOTH()[SECT_LEN:]
 
         return result
 
@@ -370,6 +537,7 @@ def IF(*args):
                 result = CALL(*args)
         else:
                 result = COPY(args[0], RET_VAL)
+        if_labs = current().if_labs
         if_labs.append(new_label())
         result += COPY(if_labs[-1], WORK[2])
         result += line("zjump",     RET_VAL, WORK[2])
@@ -377,9 +545,12 @@ def IF(*args):
         return result
 
 def ENDIF():
-        return (if_labs.pop()[0] + ":").ljust(SECT_LEN) + NOTH()[SECT_LEN:]
+        label = current().if_labs.pop()
+
+        return (label[0] + ":").ljust(SECT_LEN) + NOTH()[SECT_LEN:]
 
 def WHILE(*args):
+        while_labs = current().while_labs
         while_labs.append(new_label())
         result  = (while_labs[-1][0] + ":").ljust(SECT_LEN) + NOTH()[SECT_LEN:]
         result += IF(*args)
@@ -387,7 +558,7 @@ def WHILE(*args):
         return result
 
 def ENDWHILE():
-        result  = JUMP(while_labs.pop())
+        result  = JUMP(current().while_labs.pop())
         result += ENDIF()
 
         return result
@@ -0,0 +1,170 @@
+# Copyright 2020 Christian Seberino
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+N_REGS  = 16
+IP      = 0
+ALL     = 2 ** N_REGS - 1
+SCRATCH = 0b11110000
+ARITH   = ["add", "sub", "mult", "div", "and", "or"]
+JUMPS   = ["zjump", "gjump"]
+FUNCS   = ARITH + JUMPS + ["copy", "load", "store", "stop"]
+
+class Instr:
+        def __init__(self, word, meta):
+                e_          = word.split()
+                self.labels = [e_[0][:e_[0].find(":")]] if ":" in e_[0] else []
+                e_          = e_[1:] if self.labels else e_
+                self.func   = e_[0]
+                self.args   = e_[1:]
+                self.meta   = meta
+                self.pinned = False
+                self.live   = 0
+
+        def replace_reads(self, old, new):
+                n_reads   = {"load" : 1, "copy" : 0, "stop" : 0}
+                n_reads   = 2 if self.func in ARITH else \
+                                         n_reads.get(self.func, len(self.args))
+                self.args = [new if i < n_reads and e == old else e
+                                               for i, e in enumerate(self.args)]
+
+        def get_reg(self, i):
+                return int(self.args[i][1:])
+
+        def reads(self):
+                if   self.func in ARITH:
+                        result = 1 << self.get_reg(0) | 1 << self.get_reg(1)
+                elif self.func in JUMPS + ["store"]:
+                        result = 0
+                        for i in range(len(self.args)):
+                                result |= 1 << self.get_reg(i)
+                elif self.func == "load":
+                        result = 1 << self.get_reg(0)
+                elif self.func in ["copy", "stop"]:
+                        result = 0
+                else:
+                        result = ALL
+
+                return result
+
+        def writes(self):
+                if   self.func in ARITH:
+                        result = 1 << self.get_reg(2)
+                elif self.func in ["copy", "load"]:
+                        result = 1 << self.get_reg(1)
+                else:
+                        result = 0
+
+                return result
+
+        def is_data(self):
+                return self.func not in FUNCS
+
+        def is_move(self):
+                return self.func in ["and", "or"] and \
+                                                   self.args[0] == self.args[1]
+
+        def is_noth(self):
+                return self.is_move() and self.args[1] == self.args[2] and \
+                                                       self.get_reg(0) != IP
+
+        def ends_block(self):
+                return self.func in JUMPS + ["stop"] or self.is_data() or \
+                                                 self.writes() & 1 << IP
+
+        def word(self):
+                word = " ".join([self.func] + self.args)
+
+                return f"{self.labels[0]}: {word}" if self.labels else word
+
+def pin(instrs):
+        for i, e in enumerate(instrs):
+                if not e.is_data() and e.reads() & 1 << IP:
+                        for instr in instrs[i:]:
+                                instr.pinned = True
+                                if instr.is_data():
+                                        break
+
+def remove(instrs, dead):
+        result = []
+        labels = []
+        for i, e in enumerate(instrs):
+                if i in dead:
+                        labels += e.labels
+                else:
+                        e.labels = labels + e.labels
+                        labels   = []
+                        result.append(e)
+
+        return result, labels
+
+def propagate(instrs):
+        for i, e in enumerate(instrs):
+                if not e.is_move() or e.is_noth() or e.pinned or \
+                                   (e.reads() | e.writes()) & 1 << IP:
+                        continue
+                regs = e.reads() | e.writes()
+                for instr in instrs[i + 1:]:
+                        if instr.labels or instr.pinned:
+                                break
+                        instr.replace_reads(e.args[2], e.args[0])
+                        if instr.ends_block() or instr.writes() & regs:
+                                break
+
+def get_live(instrs):
+        targets = [i for i, e in enumerate(instrs) if e.labels] + [0]
+        live    = (len(instrs) + 1) * [0]
+        entry   = 0
+        while True:
+                live[-1] = ALL
+                for i in reversed(range(len(instrs))):
+                        e   = instrs[i]
+                        out = ALL if e.func == "stop" else live[i + 1]
+                        if e.ends_block() and e.func != "stop":
+                                out |= entry
+                        e.live  = out
+                        live[i] = e.reads() | out & ~e.writes()
+                entry_ = 0
+                for i in targets:
+                        entry_ |= live[i]
+                if entry_ == entry:
+                        break
+                entry = entry_
+
+def get_dead(instrs):
+        get_live(instrs)
+
+        return {i for i, e in enumerate(instrs)
+                      if e.func in ARITH + ["copy"] and not e.pinned and
+                      e.meta[2] is not None and e.writes() & SCRATCH and
+                      not e.writes() & e.live}
+
+def optimize(lines):
+        instrs = [Instr(e[0], e[1:]) for e in lines]
+        pin(instrs)
+        noth        = {i for i, e in enumerate(instrs)
+                                              if e.is_noth() and not e.pinned}
+        instrs, end = remove(instrs, noth)
+        while True:
+                propagate(instrs)
+                dead = get_dead(instrs)
+                if not dead:
+                        break
+                instrs, end_ = remove(instrs, dead)
+                end         += end_
+        lines  = [(e.word(),) + e.meta for e in instrs]
+        extra  = {f : i for i, e in enumerate(instrs) for f in e.labels[1:]}
+        extra.update({e : len(instrs) for e in end})
+
+        return lines, extra
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+#
+# Copyright 2020 Christian Seberino
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import sys
+sys.path.append("..")
+
+import importlib.machinery
+import machine
+import macros
+import subprocess
+import types
+import time
+import os
+
+try:
+        import numpy
+        import lockstep
+except ImportError:
+        lockstep = None
+
+LOTS = \
+"""
+      copy  0x8      r1
+      copy  0x9      r2
+      copy  0xaabbcc r10
+      add   r1  r2 r3
+      sub   r10 r1 r4
+      mult  r1  r2 r5
+      div   r4  r3 r6
+      and   r6  r4 r7
+      or    r7  r1 r8
+      copy  data r9
+      load  r9   r10
+      add   r9   r2  r9
+      store r10  r9
+      stop
+data: 0xdeadbeef
+"""
+
+LOOP = \
+"""
+      copy  200000 r1
+      copy  0x1    r2
+      copy  loop   r11
+loop: add   r3  r2  r3
+      mult  r3  r2  r4
+      div   r4  r2  r5
+      and   r5  r3  r6
+      or    r6  r2  r7
+      copy  data r9
+      load  r9   r10
+      store r10  r9
+      sub   r1  r2  r1
+      gjump r1  r12 r11
+      stop
+data: 0xdeadbeef
+"""
+
+MACRO_LOOP = \
+"""
+                COPY code_seg_end r1
+                ADD  r1           80 r1
+
+                COPY 3000 r8
+                WHILE r8
+                LSHIFT r8 5  r9
+                SUB    r8 1  r8
+                ENDWHILE
+
+                stop
+
+code_seg_end:   NOTH
+"""
+
+MACRO_BLOCK = \
+"""
+loop_{0}:       WHILE  r8
+                PUSH   r9
+                LSHIFT r8 5 r9
+                POP    r9
+                IF     r9
+                SUB    r8 1 r8
+                ENDIF
+                ENDWHILE
+"""
+
+loader    = importlib.machinery.SourceFileLoader("assembler", "../assembler")
+assembler = types.ModuleType(loader.name)
+loader.exec_module(assembler)
+
+def get_code(program):
+        with open("__program__", "w") as f:
+                f.write(program)
+        code = subprocess.check_output(["../assembler", "__program__"]).decode()
+        code = bytes.fromhex(code)
+        os.remove("__program__")
+
+        return code
+
+def legacy_step(regs, memory):
+        word = machine.get_word(regs[machine.IP], memory)
+        func = machine.FUNCS[word[0] >> (machine.BYTE_SIZE // 2)]
+        vars(machine)[func](word, regs, memory)
+        regs[machine.IP] += machine.WORD_SIZE
+
+        return func
+
+def legacy(code):
+        regs, memory, n_instrs = machine.N_REGS * [0], bytearray(code), 1
+        while legacy_step(regs, memory) != "stop":
+                n_instrs += 1
+
+        return n_instrs
+
+def stepper(code):
+        computer = machine.Machine(bytearray(code))
+        while computer.step() != machine.STOP:
+                pass
+
+        return computer.steps
+
+def runner(code):
+        computer = machine.Machine(bytearray(code))
+        computer.run()
+
+        return computer.steps
+
+def run(execute, code, min_time):
+        n_instrs = 0
+        beg      = time.perf_counter()
+        while time.perf_counter() - beg < min_time:
+                n_instrs += execute(code)
+
+        return n_instrs / (time.perf_counter() - beg)
+
+def bench_emulator(min_time):
+        print("emulator instructions per second:\n")
+        print(f"\t{'':<12} {'legacy':>12} {'step':>12} {'blocks':>12}")
+        for name, program in [("LOTS", LOTS), ("LOOP", LOOP),
+                                                    ("MACRO_LOOP", MACRO_LOOP)]:
+                code   = get_code(program)
+                rates  = [run(e, code, min_time) for e in [legacy, stepper,
+                                                                      runner]]
+                print(f"\t{name:<12} " + " ".join(f"{e:>12,.0f}" for e in rates)
+                                      + f"    speedup: {rates[-1] / rates[0]:.1f}x")
+
+def machines_runner(n):
+        def execute(code):
+                return sum(runner(code) for e in range(n))
+
+        return execute
+
+def lockstep_runner(n):
+        def execute(code):
+                regs     = numpy.zeros((n, machine.N_REGS), dtype = numpy.uint32)
+                machines = lockstep.Lockstep(code, regs)
+                machines.run()
+
+                return int(machines.steps.sum())
+
+        return execute
+
+def bench_lockstep(min_time):
+        code = get_code(LOOP.replace("200000", "2000"))
+        print("\nlockstep instructions per second:\n")
+        print(f"\t{'machines':<12} {'blocks':>12} {'lockstep':>12}")
+        for n in [10, 100, 1000]:
+                rates  = [run(machines_runner(n), code, min_time),
+                          run(lockstep_runner(n), code, min_time)]
+                print(f"\t{n:<12} " + " ".join(f"{e:>12,.0f}" for e in rates)
+                                      + f"    speedup: {rates[-1] / rates[0]:.1f}x")
+
+def bench_macros(min_time):
+        print("\nmacro expansion source lines per second:\n")
+        for n_blocks in [100, 1000, 5000]:
+                program  = "".join(MACRO_BLOCK.format(i)
+                                                     for i in range(n_blocks))
+                size     = program.count("\n")
+                n_lines  = 0
+                beg      = time.perf_counter()
+                while time.perf_counter() - beg < min_time:
+                        macros.replace(program)
+                        n_lines += size
+                rate     = n_lines / (time.perf_counter() - beg)
+                print(f"\t{size:>6} lines {rate:>12,.0f}")
+
+def legacy_hex(e, n_bytes):
+        e = int(e, assembler.HEX) if str(e).startswith("0x") else e
+
+        return hex(int(e))[2:].zfill(int(2 * n_bytes))
+
+def legacy_word(word, labels):
+        word = word.split()[1:] if ":" in word else word.split()
+        if word[0] in assembler.FUNCS:
+                func = legacy_hex(assembler.FUNCS.index(word[0]), 0.5)
+                if word[0] == "copy":
+                        const = word[1]
+                        const = labels[const] if const in labels else const
+                        const = legacy_hex(const,       assembler.CONST_SIZE)
+                        reg   = legacy_hex(word[2][1:], 0.5)
+                        word  = func + const + reg
+                else:
+                        regs  = [legacy_hex(r[1:], 0.5) for r in word[1:]]
+                        pad   = (2 * assembler.WORD_SIZE - 1 - len(regs)) * "0"
+                        word  = func + "".join(regs) + pad
+        else:
+                const = labels[word[0]] if word[0] in labels else word[0]
+                const = legacy_hex(const, assembler.WORD_SIZE)
+                word  = const
+
+        return word
+
+def legacy_encode(words, labels):
+        return bytes.fromhex("".join(legacy_word(e, labels) for e in words))
+
+def bench_assembler(min_time):
+        lines  = [e.strip() for e in LOTS.split("\n") if e.strip()]
+        words  = [e.replace("data", f"data_{i}")
+                      for i in range(100000 // len(lines) + 1) for e in lines]
+        labels = {e.split(":")[0] : assembler.WORD_SIZE * i
+                                       for i, e in enumerate(words) if ":" in e}
+        print("\nassembler words encoded per second:\n")
+        print(f"\t{'words':<12} {'hex':>12} {'struct':>12}")
+        rates  = []
+        for encode in [legacy_encode, assembler.encode]:
+                n_words = 0
+                beg     = time.perf_counter()
+                while time.perf_counter() - beg < min_time:
+                        encode(words, labels)
+                        n_words += len(words)
+                rates.append(n_words / (time.perf_counter() - beg))
+        print(f"\t{len(words):<12} " + " ".join(f"{e:>12,.0f}" for e in rates)
+                                      + f"    speedup: {rates[-1] / rates[0]:.1f}x")
+
+min_time = float(sys.argv[1]) if len(sys.argv) > 1 else 2.0
+bench_emulator(min_time)
+bench_macros(min_time)
+bench_assembler(min_time)
+if lockstep:
+        bench_lockstep(min_time)
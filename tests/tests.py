@@ -19,11 +19,20 @@ import sys
 sys.path.append("..")
 
 import macros
+import machine
 import unittest
 import subprocess
-import importlib
+import concurrent.futures
+import struct
+import json
+import io
 import os
 
+try:
+        import lockstep
+except ImportError:
+        lockstep = None
+
 def get_code(program):
         with open("__program__", "w") as f:
                 f.write(program)
@@ -33,19 +42,17 @@ def get_code(program):
 
         return code
 
-def get_output(program):
-        with open("__program__.mem", "wb") as f:
-                f.write(get_code(program))
-        output = subprocess.check_output(["../emulator", "__program__.mem"])
+def get_output(program, *args):
+        with open("__program__", "w") as f:
+                f.write(program)
+        subprocess.call(["../assembler", "__program__", "-o", "__program__.mem"])
+        output = subprocess.check_output(["../emulator", "__program__.mem",
+                                                                        *args])
+        os.remove("__program__")
         os.remove("__program__.mem")
 
         return output
 
-def create_emu_mod():
-        subprocess.call(["cp", "../emulator", "__emulator__.py"])
-        with open("__emulator__.py") as f: contents = f.readlines()
-        with open("__emulator__.py", "w") as f: f.write("".join(contents[:-13]))
-
 class Tester(unittest.TestCase):
         def test_add_assem(self):
                 program = \
@@ -159,6 +166,17 @@ copy 0xaabbcc r4
                 answer  = bytes.fromhex(answer)
                 self.assertEqual(output, answer)
 
+        def test_bad_reg_assem(self):
+                for program in ["add r2 r16 r4\n", "copy 0x3 r99\n"]:
+                        with open("__program__", "w") as f:
+                                f.write(program)
+                        output = subprocess.run(["../assembler", "__program__"],
+                                                capture_output = True)
+                        os.remove("__program__")
+                        self.assertNotEqual(output.returncode, 0)
+                        self.assertIn(b"ValueError: invalid register: r",
+                                                                 output.stderr)
+
         def test_load_assem(self):
                 program = \
 """
@@ -281,267 +299,251 @@ label_2: zjump r1 r2
                 self.assertEqual(output, answer)
 
         def test_get_word_emul(self):
-                create_emu_mod()
-                import __emulator__ as e ; importlib.reload(e)
-                subprocess.call(["rm", "__emulator__.py"])
-
-                e.memory = bytearray.fromhex("aabbccddeeff")
-                output   = e.get_word(1, e.memory), e.memory
+                memory   = bytearray.fromhex("aabbccddeeff")
+                output   = machine.get_word(1, memory), memory
                 answer   = (bytes.fromhex("bbccddee"),
                             bytes.fromhex("aabbccddeeff"))
                 self.assertEqual(output, answer)
 
-                e.memory = bytearray.fromhex("aabbccddeeff")
-                output   = e.get_word(4, e.memory), e.memory
+                memory   = bytearray.fromhex("aabbccddeeff")
+                output   = machine.get_word(4, memory), memory
                 answer   = (bytes.fromhex("eeff0000"),
                             bytes.fromhex("aabbccddeeff0000"))
                 self.assertEqual(output, answer)
 
-                e.memory = bytearray.fromhex("aabbccddeeff")
-                output   = e.get_word(7, e.memory), e.memory
+                memory   = bytearray.fromhex("aabbccddeeff")
+                output   = machine.get_word(7, memory), memory
                 answer   = (bytes.fromhex("00000000"),
                             bytes.fromhex("aabbccddeeff0000000000"))
                 self.assertEqual(output, answer)
 
         def test_set_word_emul(self):
-                create_emu_mod()
-                import __emulator__ as e ; importlib.reload(e)
-                subprocess.call(["rm", "__emulator__.py"])
-
-                e.memory = bytearray.fromhex("aabbccddeeff")
-                e.set_word(bytes.fromhex("deadbeef"), 1, e.memory)
-                output   = e.memory
+                memory   = bytearray.fromhex("aabbccddeeff")
+                machine.set_word(bytes.fromhex("deadbeef"), 1, memory)
+                output   = memory
                 answer   = bytes.fromhex("aadeadbeefff")
                 self.assertEqual(output, answer)
 
-                e.memory = bytearray.fromhex("aabbccddeeff")
-                e.set_word(bytes.fromhex("deadbeef"), 4, e.memory)
-                output   = e.memory
+                memory   = bytearray.fromhex("aabbccddeeff")
+                machine.set_word(bytes.fromhex("deadbeef"), 4, memory)
+                output   = memory
                 answer   = bytes.fromhex("aabbccdddeadbeef")
                 self.assertEqual(output, answer)
 
-                e.memory = bytearray.fromhex("aabbccddeeff")
-                e.set_word(bytes.fromhex("deadbeef"), 7, e.memory)
-                output   = e.memory
+                memory   = bytearray.fromhex("aabbccddeeff")
+                machine.set_word(bytes.fromhex("deadbeef"), 7, memory)
+                output   = memory
                 answer   = bytes.fromhex("aabbccddeeff00deadbeef")
                 self.assertEqual(output, answer)
 
         def test_get_reg_args_emul(self):
-                create_emu_mod()
-                import __emulator__ as e ; importlib.reload(e)
-                subprocess.call(["rm", "__emulator__.py"])
-
-                output = e.get_reg_args(bytes.fromhex("abcdef78"))
+                output = machine.get_reg_args(bytes.fromhex("abcdef78"))
                 answer = (11, 12, 13)
                 self.assertEqual(output, answer)
 
-                output = e.get_reg_args(bytes.fromhex("a83fef78"))
+                output = machine.get_reg_args(bytes.fromhex("a83fef78"))
                 answer = (8, 3, 15)
                 self.assertEqual(output, answer)
 
-        def test_add_emul(self):
-                create_emu_mod()
-                import __emulator__ as e ; importlib.reload(e)
-                subprocess.call(["rm", "__emulator__.py"])
+        def test_fixed_memory_emul(self):
+                memory   = machine.FixedMemory.fromhex("aabbccddeeff0000")
+                output   = machine.get_word(4, memory), memory
+                answer   = (bytes.fromhex("eeff0000"),
+                            bytes.fromhex("aabbccddeeff0000"))
+                self.assertEqual(output, answer)
+
+                memory   = machine.FixedMemory.fromhex("aabbccddeeff")
+                with self.assertRaises(machine.Fault):
+                        machine.get_word(4, memory)
+                with self.assertRaises(machine.Fault):
+                        machine.set_word(bytes.fromhex("deadbeef"), 3, memory)
+                output   = memory
+                answer   = bytes.fromhex("aabbccddeeff")
+                self.assertEqual(output, answer)
+
+        def test_paged_memory_emul(self):
+                memory   = machine.PagedMemory(bytes.fromhex("aabbccddeeff"))
+                output   = machine.get_word(4, memory), len(memory.pages)
+                answer   = (bytes.fromhex("eeff0000"), 0)
+                self.assertEqual(output, answer)
+
+                output   = machine.get_word(0xfffffff0, memory), len(memory.pages)
+                answer   = (bytes.fromhex("00000000"), 0)
+                self.assertEqual(output, answer)
+
+                machine.set_word(bytes.fromhex("deadbeef"), 0x1ffe, memory)
+                output   = machine.get_word(0x1ffd, memory), len(memory.pages)
+                answer   = (bytes.fromhex("00deadbe"), 2)
+                self.assertEqual(output, answer)
+
+                machine.set_word(bytes.fromhex("01020304"), 0x2, memory)
+                output   = machine.get_word(0x0, memory), memory.image
+                answer   = (bytes.fromhex("aabb0102"),
+                            bytes.fromhex("aabbccddeeff"))
+                self.assertEqual(output, answer)
 
-                e.regs     = list(range(10, 26))
-                e.add(bytes.fromhex("095f0000"), e.regs, None)
-                output     = e.regs
+                output   = [beg for beg, page in memory.regions()]
+                answer   = [0x0000, 0x1000, 0x2000]
+                self.assertEqual(output, answer)
+
+                with self.assertRaises(machine.Fault):
+                        machine.get_word(0xfffffffe, memory)
+
+        def test_add_emul(self):
+                regs       = list(range(10, 26))
+                machine.add(bytes.fromhex("095f0000"), regs, None)
+                output     = regs
                 answer     = list(range(10, 26))
                 answer[15] = 19 + 15
                 self.assertEqual(output, answer)
 
         def test_sub_emul(self):
-                create_emu_mod()
-                import __emulator__ as e ; importlib.reload(e)
-                subprocess.call(["rm", "__emulator__.py"])
-
-                e.regs     = list(range(10, 26))
-                e.sub(bytes.fromhex("095f0000"), e.regs, None)
-                output     = e.regs
+                regs       = list(range(10, 26))
+                machine.sub(bytes.fromhex("095f0000"), regs, None)
+                output     = regs
                 answer     = list(range(10, 26))
                 answer[15] = 19 - 15
                 self.assertEqual(output, answer)
 
         def test_mult_emul(self):
-                create_emu_mod()
-                import __emulator__ as e ; importlib.reload(e)
-                subprocess.call(["rm", "__emulator__.py"])
-
-                e.regs     = list(range(10, 26))
-                e.mult(bytes.fromhex("095f0000"), e.regs, None)
-                output     = e.regs
+                regs       = list(range(10, 26))
+                machine.mult(bytes.fromhex("095f0000"), regs, None)
+                output     = regs
                 answer     = list(range(10, 26))
                 answer[15] = 19 * 15
                 self.assertEqual(output, answer)
 
         def test_div_emul(self):
-                create_emu_mod()
-                import __emulator__ as e ; importlib.reload(e)
-                subprocess.call(["rm", "__emulator__.py"])
-
-                e.regs     = list(range(10, 26))
-                e.div(bytes.fromhex("095f0000"), e.regs, None)
-                output     = e.regs
+                regs       = list(range(10, 26))
+                machine.div(bytes.fromhex("095f0000"), regs, None)
+                output     = regs
                 answer     = list(range(10, 26))
                 answer[15] = int(19 / 15)
                 self.assertEqual(output, answer)
 
         def test_and_emul(self):
-                create_emu_mod()
-                import __emulator__ as e ; importlib.reload(e)
-                subprocess.call(["rm", "__emulator__.py"])
-
-                e.regs     = list(range(10, 26))
-                e.and_(bytes.fromhex("095f0000"), e.regs, None)
-                output     = e.regs
+                regs       = list(range(10, 26))
+                machine.and_(bytes.fromhex("095f0000"), regs, None)
+                output     = regs
                 answer     = list(range(10, 26))
                 answer[15] = 19 & 15
                 self.assertEqual(output, answer)
 
         def test_or_emul(self):
-                create_emu_mod()
-                import __emulator__ as e ; importlib.reload(e)
-                subprocess.call(["rm", "__emulator__.py"])
-
-                e.regs     = list(range(10, 26))
-                e.or_(bytes.fromhex("095f0000"), e.regs, None)
-                output     = e.regs
+                regs       = list(range(10, 26))
+                machine.or_(bytes.fromhex("095f0000"), regs, None)
+                output     = regs
                 answer     = list(range(10, 26))
                 answer[15] = 19 | 15
                 self.assertEqual(output, answer)
 
         def test_copy_emul(self):
-                create_emu_mod()
-                import __emulator__ as e ; importlib.reload(e)
-                subprocess.call(["rm", "__emulator__.py"])
-
-                e.regs     = list(range(10, 26))
-                e.copy(bytes.fromhex("deadbeef"), e.regs, None)
-                output     = e.regs
+                regs       = list(range(10, 26))
+                machine.copy(bytes.fromhex("deadbeef"), regs, None)
+                output     = regs
                 answer     = list(range(10, 26))
                 answer[15] = 0xeadbee
                 self.assertEqual(output, answer)
 
         def test_load_emul(self):
-                create_emu_mod()
-                import __emulator__ as e ; importlib.reload(e)
-                subprocess.call(["rm", "__emulator__.py"])
-
-                e.memory  = bytearray.fromhex("aabbccddeeff")
-                e.regs    = list(range(1, 17))
-                e.load(bytes.fromhex("01300000"), e.regs, e.memory)
-                output    = e.regs, e.memory
+                memory    = bytearray.fromhex("aabbccddeeff")
+                regs      = list(range(1, 17))
+                machine.load(bytes.fromhex("01300000"), regs, memory)
+                output    = regs, memory
                 answer    = list(range(1, 17))
                 answer[3] = 0xccddeeff
                 answer    = answer, bytes.fromhex("aabbccddeeff")
                 self.assertEqual(output, answer)
 
-                e.memory  = bytearray.fromhex("aabbccddeeff")
-                e.regs    = list(range(1, 17))
-                e.load(bytes.fromhex("03900000"), e.regs, e.memory)
-                output    = e.regs, e.memory
+                memory    = bytearray.fromhex("aabbccddeeff")
+                regs      = list(range(1, 17))
+                machine.load(bytes.fromhex("03900000"), regs, memory)
+                output    = regs, memory
                 answer    = list(range(1, 17))
                 answer[9] = 0xeeff0000
                 answer    = answer, bytes.fromhex("aabbccddeeff0000")
                 self.assertEqual(output, answer)
 
-                e.memory  = bytearray.fromhex("aabbccddeeff")
-                e.regs    = list(range(1, 17))
-                e.load(bytes.fromhex("06900000"), e.regs, e.memory)
-                output    = e.regs, e.memory
+                memory    = bytearray.fromhex("aabbccddeeff")
+                regs      = list(range(1, 17))
+                machine.load(bytes.fromhex("06900000"), regs, memory)
+                output    = regs, memory
                 answer    = list(range(1, 17))
                 answer[9] = 0x00000000
                 answer    = answer, bytes.fromhex("aabbccddeeff0000000000")
                 self.assertEqual(output, answer)
 
         def test_store_emul(self):
-                create_emu_mod()
-                import __emulator__ as e ; importlib.reload(e)
-                subprocess.call(["rm", "__emulator__.py"])
-
-                e.memory   = bytearray.fromhex("aabbccddeeff")
-                e.regs     = list(range(1, 17))
-                e.regs[11] = 0xdeadbeef
-                e.store(bytes.fromhex("0b100000"), e.regs, e.memory)
-                output     = e.regs, e.memory
+                memory     = bytearray.fromhex("aabbccddeeff")
+                regs       = list(range(1, 17))
+                regs[11]   = 0xdeadbeef
+                machine.store(bytes.fromhex("0b100000"), regs, memory)
+                output     = regs, memory
                 answer     = list(range(1, 17))
                 answer[11] = 0xdeadbeef
                 answer     = (answer, bytes.fromhex("aabbdeadbeef"))
                 self.assertEqual(output, answer)
 
-                e.memory   = bytearray.fromhex("aabbccddeeff")
-                e.regs     = list(range(1, 17))
-                e.regs[11] = 0xdeadbeef
-                e.store(bytes.fromhex("0b300000"), e.regs, e.memory)
-                output     = e.regs, e.memory
+                memory     = bytearray.fromhex("aabbccddeeff")
+                regs       = list(range(1, 17))
+                regs[11]   = 0xdeadbeef
+                machine.store(bytes.fromhex("0b300000"), regs, memory)
+                output     = regs, memory
                 answer     = list(range(1, 17))
                 answer[11] = 0xdeadbeef
                 answer     = (answer, bytes.fromhex("aabbccdddeadbeef"))
                 self.assertEqual(output, answer)
 
-                e.memory   = bytearray.fromhex("aabbccddeeff")
-                e.regs     = list(range(1, 17))
-                e.regs[11] = 0xdeadbeef
-                e.store(bytes.fromhex("0b600000"), e.regs, e.memory)
-                output     = e.regs, e.memory
+                memory     = bytearray.fromhex("aabbccddeeff")
+                regs       = list(range(1, 17))
+                regs[11]   = 0xdeadbeef
+                machine.store(bytes.fromhex("0b600000"), regs, memory)
+                output     = regs, memory
                 answer     = list(range(1, 17))
                 answer[11] = 0xdeadbeef
                 answer     = (answer, bytes.fromhex("aabbccddeeff00deadbeef"))
                 self.assertEqual(output, answer)
 
         def test_zjump_emul(self):
-                create_emu_mod()
-                import __emulator__ as e ; importlib.reload(e)
-                subprocess.call(["rm", "__emulator__.py"])
-
-                e.regs    = list(range(11, 27))
-                e.regs[4] = 9999
-                e.zjump(bytes.fromhex("04300000"), e.regs, None)
-                output    = e.regs
+                regs      = list(range(11, 27))
+                regs[4] = 9999
+                machine.zjump(bytes.fromhex("04300000"), regs, None)
+                output    = regs
                 answer    = list(range(11, 27))
                 answer[4] = 9999
                 self.assertEqual(output, answer)
 
-                e.regs    = list(range(11, 27))
-                e.regs[4] = 0
-                e.zjump(bytes.fromhex("04300000"), e.regs, None)
-                output    = e.regs
+                regs      = list(range(11, 27))
+                regs[4] = 0
+                machine.zjump(bytes.fromhex("04300000"), regs, None)
+                output    = regs
                 answer    = list(range(11, 27))
                 answer[4] = 0
                 answer[0] = 10
                 self.assertEqual(output, answer)
 
         def test_gjump_emul(self):
-                create_emu_mod()
-                import __emulator__ as e ; importlib.reload(e)
-                subprocess.call(["rm", "__emulator__.py"])
-
-                e.regs    = list(range(11, 27))
-                e.regs[4] = 9999
-                e.gjump(bytes.fromhex("03450000"), e.regs, None)
-                output    = e.regs
+                regs      = list(range(11, 27))
+                regs[4] = 9999
+                machine.gjump(bytes.fromhex("03450000"), regs, None)
+                output    = regs
                 answer    = list(range(11, 27))
                 answer[4] = 9999
                 self.assertEqual(output, answer)
 
-                e.regs    = list(range(11, 27))
-                e.regs[4] = 0
-                e.gjump(bytes.fromhex("03450000"), e.regs, None)
-                output    = e.regs
+                regs      = list(range(11, 27))
+                regs[4] = 0
+                machine.gjump(bytes.fromhex("03450000"), regs, None)
+                output    = regs
                 answer    = list(range(11, 27))
                 answer[4] = 0
                 answer[0] = 12
                 self.assertEqual(output, answer)
 
         def test_stop_emul(self):
-                create_emu_mod()
-                import __emulator__ as e ; importlib.reload(e)
-                subprocess.call(["rm", "__emulator__.py"])
-
-                e.regs = list(range(1, 17))
-                e.stop(bytes.fromhex("0b100000"), e.regs, None)
-                output = e.regs
+                regs   = list(range(1, 17))
+                machine.stop(bytes.fromhex("0b100000"), regs, None)
+                output = regs
                 answer = list(range(1, 17))
                 self.assertEqual(output, answer)
 
@@ -924,6 +926,650 @@ memory:
 """.lstrip()
                 self.assertEqual(output, answer)
 
+        def test_self_modifying(self):
+                program = \
+"""
+        copy  2      r5
+        copy  1      r4
+        copy  target r7
+        copy  target r10
+        copy  new    r1
+        load  r1     r2
+target: copy  0xaaa  r3
+        add   r3     r8  r8
+        store r2     r7
+        sub   r5     r4  r5
+        gjump r5     r9  r10
+        stop
+new:    copy  0xbbb  r3
+"""
+                output = get_output(program)
+                output = output.decode()
+                output = output[:output.find("memory")].strip()[31 + 7 * 17:]
+                answer = \
+"""
+	 r8: 0x00001665
+	 r9: 0x00000000
+	r10: 0x00000018
+	r11: 0x00000000
+	r12: 0x00000000
+	r13: 0x00000000
+	r14: 0x00000000
+	r15: 0x00000000
+""".strip()
+                self.assertEqual(output, answer)
+
+        def test_self_modifying_block(self):
+                program = \
+"""
+        copy  40     r5
+        copy  1      r4
+        copy  0x10   r6
+        copy  target r7
+        copy  loop   r10
+        load  r7     r2
+loop:   add   r2     r6  r2
+        store r2     r7
+target: copy  0x0    r3
+        add   r3     r8  r8
+        sub   r5     r4  r5
+        gjump r5     r9  r10
+        stop
+"""
+                output = get_output(program)
+                output = output.decode()
+                output = output[:output.find("memory")].strip()[31 + 2 * 17:]
+                answer = \
+"""
+	 r3: 0x00000028
+	 r4: 0x00000001
+	 r5: 0x00000000
+	 r6: 0x00000010
+	 r7: 0x00000020
+	 r8: 0x00000334
+	 r9: 0x00000000
+	r10: 0x00000018
+	r11: 0x00000000
+	r12: 0x00000000
+	r13: 0x00000000
+	r14: 0x00000000
+	r15: 0x00000000
+""".strip()
+                self.assertEqual(output, answer)
+
+        def test_store_ip_block(self):
+                program  = \
+"""
+        copy  20     r5
+        copy  1      r4
+        copy  slot   r7
+        copy  loop   r10
+loop:   store r0     r7
+        sub   r5     r4  r5
+        gjump r5     r9  r10
+        stop
+slot:   0x0
+"""
+                code     = get_code(program)
+                computer = machine.Machine(bytearray(code))
+                computer.run()
+                stepper  = machine.Machine(bytearray(code))
+                while stepper.step() != machine.STOP:
+                        pass
+                self.assertEqual(computer.regs, stepper.regs)
+                self.assertEqual(computer.memory, stepper.memory)
+                self.assertEqual(computer.memory[32:36],
+                                                     bytes.fromhex("00000010"))
+
+        def test_memory_size(self):
+                program = \
+"""
+        copy  0x8    r1
+        copy  data   r2
+        load  r2     r3
+        stop
+data:   0xdeadbeef
+"""
+                output = get_output(program, "--memory-size", "0x20")
+                output = output.decode()
+                output = output[output.find("memory"):]
+                answer = \
+"""
+memory:
+
+	0x00000000: 0x80000081
+	0x00000004: 0x80000102
+	0x00000008: 0x92300000
+	0x0000000c: 0xb0000000
+	0x00000010: 0xdeadbeef
+	0x00000014: 0x00000000
+	0x00000018: 0x00000000
+	0x0000001c: 0x00000000
+""".lstrip()
+                self.assertEqual(output, answer)
+
+                program = \
+"""
+        copy  0x20   r1
+        load  r1     r3
+        stop
+"""
+                with open("__program__.mem", "wb") as f:
+                        f.write(get_code(program))
+                output = subprocess.run(["../emulator", "__program__.mem",
+                                                          "-m", "0x20"],
+                                        capture_output = True)
+                os.remove("__program__.mem")
+                self.assertEqual(output.returncode, 1)
+                self.assertEqual(output.stderr,
+                               b"fault: memory access out of range at 0x00000020\n")
+                output = output.stdout.decode()
+                output = output[:output.find("memory")].strip()[:45]
+                answer = \
+"""
+registers:
+
+	 r0: 0x00000004
+	 r1: 0x00000020
+""".strip()
+                self.assertEqual(output, answer)
+
+        def test_paged(self):
+                program = \
+"""
+        copy  0xffff   r1
+        copy  0x10000  r2
+        mult  r1       r2 r1
+        copy  0xfff0   r3
+        add   r1       r3 r1
+        copy  0xabcdef r4
+        store r4       r1
+        load  r1       r5
+        stop
+"""
+                answer = \
+"""
+memory:
+
+	0x00000000: 0x800ffff1
+	0x00000004: 0x80100002
+	0x00000008: 0x21210000
+	0x0000000c: 0x800fff03
+	0x00000010: 0x01310000
+	0x00000014: 0x8abcdef4
+	0x00000018: 0xa4100000
+	0x0000001c: 0x91500000
+	0x00000020: 0xb0000000
+	0xfffffff0: 0x00abcdef
+""".lstrip()
+                for option in ["--paged", "--mmap"]:
+                        output = get_output(program, option)
+                        output = output.decode()
+                        output = output[output.find("memory"):].split("\n")
+                        output = "\n".join(e for e in output if not
+                                                      e.endswith(" 0x00000000"))
+                        self.assertEqual(output, answer)
+
+        def test_squeeze(self):
+                program = \
+"""
+      copy  data r9
+      copy  0x40 r1
+      store r9   r1
+      stop
+data: 0xdeadbeef
+"""
+                output = get_output(program, "--squeeze")
+                output = output.decode()
+                output = output[output.find("memory"):]
+                answer = \
+"""
+memory:
+
+	0x00000000: 0x80000109
+	0x00000004: 0x80000401
+	0x00000008: 0xa9100000
+	0x0000000c: 0xb0000000
+	0x00000010: 0xdeadbeef
+	0x00000014: 0x00000000
+	*
+	0x00000040: 0x00000010
+""".lstrip()
+                self.assertEqual(output, answer)
+
+        def test_dump_file(self):
+                program = \
+"""
+      copy  data r9
+      copy  0x40 r1
+      store r9   r1
+      stop
+data: 0xdeadbeef
+"""
+                output = get_output(program, "--dump-file", "__dump__.mem")
+                output = output.decode()
+                self.assertEqual(output.find("memory"), -1)
+                with open("__dump__.mem", "rb") as f: output = f.read()
+                os.remove("__dump__.mem")
+                answer  = get_code(program)
+                answer += bytes.fromhex(11 * "00000000" + "00000010")
+                self.assertEqual(output, answer)
+
+                program = \
+"""
+      copy  data   r9
+      copy  0x2000 r1
+      store r9     r1
+      stop
+data: 0xdeadbeef
+"""
+                get_output(program, "-p", "--dump-file", "__dump__.mem")
+                with open("__dump__.mem", "rb") as f: output = f.read()
+                os.remove("__dump__.mem")
+                output = len(output), output[0x2000:0x2004]
+                answer = 3 * machine.PAGE_SIZE, bytes.fromhex("00000010")
+                self.assertEqual(output, answer)
+
+        def test_formats(self):
+                program = \
+"""
+      copy  data r9
+      copy  0x40 r1
+      store r9   r1
+      stop
+data: 0xdeadbeef
+"""
+                output = get_output(program, "--format", "json")
+                output = json.loads(output)
+                answer = {"registers" : [0x10, 0x40] + 7 * [0] + [0x10] +
+                                                                     6 * [0],
+                          "memory"    : [{"address" : 0x00,
+                                          "data"    : "80000109" +
+                                                      "80000401" +
+                                                      "a9100000" +
+                                                      "b0000000" +
+                                                      "deadbeef"},
+                                         {"address" : 0x40,
+                                          "data"    : "00000010"}]}
+                self.assertEqual(output, answer)
+
+                output = get_output(program, "--format", "regs")
+                answer = struct.pack(">16I", *answer["registers"])
+                self.assertEqual(output, answer)
+
+                output  = get_output(program, "--format", "raw")
+                answer  = get_code(program)
+                answer += bytes.fromhex(11 * "00000000" + "00000010")
+                self.assertEqual(output, answer)
+
+        def test_machine(self):
+                program = \
+"""
+      copy  1000 r1
+      copy  0x1  r2
+      copy  loop r11
+loop: add   r3  r2  r3
+      sub   r1  r2  r1
+      gjump r1  r12 r11
+      stop
+"""
+                code     = get_code(program)
+                computer = machine.Machine(bytearray(code))
+                output   = computer.run(100), computer.steps, computer.regs[3]
+                answer   = (False, 100, 33)
+                self.assertEqual(output, answer)
+
+                other    = machine.Machine(bytearray(code))
+                output   = other.run(), other.steps, other.regs[3]
+                answer   = (True, 3004, 1000)
+                self.assertEqual(output, answer)
+                self.assertEqual(computer.regs[3], 33)
+
+                output   = computer.run(), computer.steps, computer.regs
+                answer   = (True, 3004, other.regs)
+                self.assertEqual(output, answer)
+
+        def test_batch(self):
+                programs = ["copy 0x7 r1\nstop\n",
+                            "copy 0x8 r2\ncopy 0x9 r3\nstop\n",
+                            "copy data r1\nload r1 r2\nstop\ndata: 0xabc\n"]
+                os.mkdir("__batch__")
+                answer   = {}
+                for i, program in enumerate(programs):
+                        path         = os.path.join("__batch__", f"{i}.mem")
+                        answer[path] = get_output(program)
+                        with open(path, "wb") as f:
+                                f.write(get_code(program))
+                output   = subprocess.check_output(["../emulator", "__batch__",
+                                                           "--jobs", "2"])
+                output   = output.split(b"==> ")[1:]
+                output   = dict(e.decode().split(" <==\n") for e in output)
+                output   = {k : v.encode() for k, v in output.items()}
+                self.assertEqual(output, answer)
+
+                output   = subprocess.run(["../emulator",
+                                           "__batch__/0.mem", "__missing__.mem"],
+                                          capture_output = True)
+                subprocess.call(["rm", "-r", "__batch__"])
+                self.assertEqual(output.returncode, 1)
+                self.assertIn(b"==> __batch__/0.mem <==\n" +
+                                     answer["__batch__/0.mem"], output.stdout)
+                self.assertIn(b"__missing__.mem: error: ", output.stderr)
+
+                with open("__program__.mem", "wb") as f:
+                        f.write(bytes.fromhex("f0000000"))
+                output   = subprocess.run(["../emulator", "__program__.mem"],
+                                          capture_output = True)
+                os.remove("__program__.mem")
+                self.assertEqual(output.returncode, 1)
+                self.assertTrue(output.stderr.startswith(b"error: "))
+
+                output   = subprocess.run(["../emulator", "__missing__.mem"],
+                                          capture_output = True)
+                self.assertEqual(output.returncode, 1)
+                self.assertTrue(output.stderr.startswith(b"error: "))
+
+        def test_limits(self):
+                program = \
+"""
+        copy  0x1    r3
+        copy  loop   r1
+loop:   add   r2     r3  r2
+        gjump r3     r4  r1
+        stop
+"""
+                with open("__program__.mem", "wb") as f:
+                        f.write(get_code(program))
+                output = subprocess.run(["../emulator", "__program__.mem",
+                                         "--max-steps", "1001", "-f", "json"],
+                                        capture_output = True)
+                self.assertEqual(output.returncode, 3)
+                self.assertEqual(output.stderr,
+                                           b"limit: stopped after 1001 steps\n")
+                output = json.loads(output.stdout)["registers"][:4]
+                answer = [12, 8, 500, 1]
+                self.assertEqual(output, answer)
+
+                output = subprocess.run(["../emulator", "__program__.mem",
+                                         "--timeout", "0.1"],
+                                        capture_output = True)
+                os.remove("__program__.mem")
+                self.assertEqual(output.returncode, 3)
+                self.assertTrue(output.stderr.startswith(b"limit: "))
+
+                computer = machine.Machine(bytearray(get_code(program)))
+                output   = (computer.run(timeout = 0), computer.steps <=
+                                        machine.TIME_STEP + machine.MAX_BLOCK)
+                answer   = (False, True)
+                self.assertEqual(output, answer)
+
+        def test_profile(self):
+                program = \
+"""
+      copy  0x3  r1
+      copy  0x1  r2
+      copy  loop r11
+loop: add   r3  r2  r3
+      sub   r1  r2  r1
+      gjump r1  r12 r11
+      stop
+"""
+                with open("__program__", "w") as f:
+                        f.write(program)
+                subprocess.call(["../assembler", "__program__", "--labels",
+                                                            "__labels__.json"],
+                                stdout = subprocess.DEVNULL)
+                with open("__labels__.json") as f:
+                        labels = json.load(f)
+                os.remove("__program__")
+                os.remove("__labels__.json")
+                self.assertEqual(labels, {"loop" : 12})
+
+                code     = get_code(program)
+                computer = machine.Machine(bytearray(code))
+                other    = machine.Machine(bytearray(code))
+                output   = computer.profile(), computer.regs, computer.steps
+                answer   = other.run(), other.regs, other.steps
+                self.assertEqual(output, answer)
+
+                output   = {machine.FUNCS[k] : v
+                                        for k, v in computer.op_counts.items()}
+                answer   = {"copy" : 3, "add" : 3, "sub" : 3, "gjump" : 3,
+                                                                  "stop" : 1}
+                self.assertEqual(output, answer)
+
+                output   = dict(computer.ip_counts)
+                answer   = {0 : 1, 4 : 1, 8 : 1, 12 : 3, 16 : 3, 20 : 3, 24 : 1}
+                self.assertEqual(output, answer)
+
+                out      = io.BytesIO()
+                machine.dump_profile(computer.op_counts, computer.ip_counts,
+                                computer.memory, out, labels, n_lines = 2)
+                output   = out.getvalue().decode().split("hot spots:")[1]
+                answer   = \
+"""
+
+	0x0000000c  loop                              3   23.1%  add r3 r2 r3
+	0x00000010  loop+4                            3   23.1%  sub r1 r2 r1
+"""
+                self.assertEqual(output, answer)
+
+        def test_binary_output(self):
+                program = \
+"""
+        COPY 0xdeadbeef r3
+        stop
+"""
+                with open("__program__", "w") as f:
+                        f.write(program)
+                subprocess.call(["../assembler", "__program__", "-o",
+                                                            "__program__.mem"])
+                with open("__program__.mem", "rb") as f:
+                        output = f.read()
+                answer = subprocess.check_output(["../assembler", "__program__",
+                                                                    "-o", "-"])
+                os.remove("__program__")
+                os.remove("__program__.mem")
+                self.assertEqual(output, answer)
+                self.assertEqual(output, get_code(program))
+
+        def test_stream(self):
+                program = \
+"""
+        COPY code_seg_end r1
+        COPY 5            r8
+        WHILE r8
+        PUSH  r8
+        POP   r9
+        SUB   r8 1 r8
+        ENDWHILE
+        JUMP  done
+table:  0xdeadbeef
+        7
+done:   stop
+code_seg_end:   NOTH
+"""
+                with open("__program__", "w") as f:
+                        f.write(program)
+                subprocess.call(["../assembler", "__program__", "--stream",
+                                 "-o", "__program__.mem", "-l", "__labels__"])
+                with open("__program__.mem", "rb") as f:
+                        output = f.read()
+                with open("__labels__") as f:
+                        labels = json.load(f)
+                answer = subprocess.check_output(["../assembler", "__program__",
+                                                   "-o", "-", "-l", "__labels__"])
+                with open("__labels__") as f:
+                        self.assertEqual(labels, json.load(f))
+                os.remove("__program__")
+                os.remove("__program__.mem")
+                os.remove("__labels__")
+                self.assertEqual(output, answer)
+
+        def test_optimize(self):
+                program = \
+"""
+                COPY code_seg_end r1
+                ADD  r1           80 r1
+
+                COPY 0  r9
+                COPY 10 r8
+                WHILE r8
+                PUSH  r8
+                ADD   r9 r8 r9
+                POP   r10
+                SUB   r8 1 r8
+                ENDWHILE
+                CALL  double r9
+                COPY  r3 r11
+                stop
+
+double:         POP    r3
+                ADD    r3 r3 r3
+                RETURN
+
+code_seg_end:   NOTH
+"""
+                with open("__program__", "w") as f:
+                        f.write(program)
+                output = subprocess.run(["../assembler", "__program__", "-O",
+                                         "-o", "__program__.mem"],
+                                        capture_output = True)
+                self.assertTrue(output.stderr.startswith(b"optimizer: removed "))
+                with open("__program__.mem", "rb") as f:
+                        code = f.read()
+                os.remove("__program__")
+                os.remove("__program__.mem")
+                self.assertLess(len(code), len(get_code(program)))
+                computer = machine.Machine(bytearray(code))
+                computer.run()
+                output   = computer.regs[8:12]
+                answer   = [0, 55, 1, 110]
+                self.assertEqual(output, answer)
+
+                program  = \
+"""
+                copy 5  r5
+                add  r5 r5 r4
+                copy 3  r6
+                mult r4 r6 r7
+                copy 9  r8
+                add  r8 r8 r8
+                stop
+"""
+                with open("__program__", "w") as f:
+                        f.write(program)
+                output   = []
+                for e in [[], ["-O"]]:
+                        code     = subprocess.check_output(["../assembler",
+                                                  "__program__", "-o", "-", *e],
+                                                  stderr = subprocess.DEVNULL)
+                        computer = machine.Machine(bytearray(code))
+                        computer.run()
+                        output.append(computer.regs)
+                os.remove("__program__")
+                self.assertEqual(output[0], output[1])
+                self.assertEqual(output[1][4:9], [0xa, 5, 3, 0x1e, 0x12])
+
+        def test_source_map(self):
+                program = \
+"""
+        COPY 0x400 r1
+
+loop:   PUSH r3
+        add  r1 r2 r3
+        stop
+"""
+                with open("__program__", "w") as f:
+                        f.write(program)
+                subprocess.call(["../assembler", "__program__", "--source-map",
+                                                               "__map__.json"],
+                                stdout = subprocess.DEVNULL)
+                with open("__map__.json") as f:
+                        output = json.load(f)
+                os.remove("__program__")
+                os.remove("__map__.json")
+                answer = [[4 * i, 2, None,   "COPY"] for i in range(2)]
+                answer = answer + [[4 * i, 4, "loop", "PUSH"]
+                                                        for i in range(2, 8)]
+                answer = answer + [[32, 5, "loop", None], [36, 6, "loop", None]]
+                self.assertEqual(output, answer)
+
+                code     = get_code(program)
+                computer = machine.Machine(bytearray(code))
+                computer.profile()
+                out      = io.BytesIO()
+                machine.dump_profile(computer.op_counts, computer.ip_counts,
+                                      computer.memory, out, source_map = output)
+                output   = out.getvalue().decode().split("source lines:")[1]
+                answer   = \
+"""
+
+	line 4      loop                 PUSH                    6   60.0%
+	line 2                           COPY                    2   20.0%
+	line 5      loop                                         1   10.0%
+	line 6      loop                                         1   10.0%
+"""
+                self.assertEqual(output, answer)
+
+        @unittest.skipIf(lockstep is None, "numpy is not installed")
+        def test_lockstep(self):
+                program = \
+"""
+      copy  0x1    r2
+      copy  loop   r11
+      copy  done   r12
+      copy  data   r9
+loop: zjump r1  r12
+      add   r3  r1  r3
+      mult  r3  r3  r4
+      div   r4  r1  r5
+      store r5  r9
+      add   r9  r2  r9
+      sub   r1  r2  r1
+      gjump r2  r13 r11
+done: stop
+data: 0x0
+"""
+                code     = get_code(program)
+                regs     = [[0, e] + 14 * [0] for e in [5, 0, 3, 5, 9, 1, 3]]
+                machines = lockstep.Lockstep(code, regs)
+                output   = machines.run(), machines.regs.tolist()
+                answer   = []
+                for e in regs:
+                        computer = machine.Machine(bytearray(code), e[:])
+                        computer.run()
+                        answer.append(computer.regs)
+                        memory   = machines.memory[len(answer) - 1].tobytes()
+                        self.assertEqual(memory[:len(computer.memory)],
+                                                        computer.memory)
+                self.assertEqual(output, (True, answer))
+
+                machines = lockstep.Lockstep(code, regs)
+                output   = machines.run(20), machines.done.tolist()
+                answer   = (False, [False, True, False, False, False, True, False])
+                self.assertEqual(output, answer)
+
+                program  = \
+"""
+        copy  skip   r12
+        copy  patch  r9
+        copy  target r10
+        zjump r1     r12
+        load  r9     r8
+        store r8     r10
+skip:   copy  0x5    r4
+target: copy  0x1    r3
+        add   r3     r4  r5
+        stop
+patch:  0x80000023
+"""
+                machines = lockstep.Lockstep(get_code(program), regs)
+                machines.run()
+                output   = machines.regs[:, 5].tolist()
+                answer   = [7, 6, 7, 7, 7, 7, 7]
+                self.assertEqual(output, answer)
+
         def test_func_calls(self):
                 program = \
 """
@@ -1505,10 +2151,19 @@ ans_e:  0x0
                           ("r3-24",     ("r3", -24)),
                           ("r15+0xabc", ("r15",  0xabc)),
                           ("r15-0xabc", ("r15", -0xabc)),
-                          ("label34",   ["label34"])]:
+                          ("label34",   ["label34"]),
+                          ("r3+",       None),
+                          ("+",         None)]:
                         output  = macros.parse_arg(e[0])
                         answer  = e[1]
                         self.assertEqual(output, answer)
+                        self.assertEqual(macros.parse_arg(e[0]), answer)
+
+                output = macros.parse_arg("label34")
+                output.append("label35")
+                output = macros.parse_arg("label34")
+                answer = ["label34"]
+                self.assertEqual(output, answer)
 
         def test_parse_args(self):
                 output = macros.parse_args(" r1 r2 r3 ".split())
@@ -1671,6 +2326,44 @@ label:          and  r1 r1 r1
 """.strip()
                 self.assertEqual(output, answer)
 
+                consts = [0xabcdef, 0x10000, 0xfffe0001, 0x1fffffe, 0xfffffff0,
+                                                        0xdeadbeef, 0x123456789]
+                output = [macros.COPY(e, "r4").count("\n") for e in consts]
+                answer = [1, 1, 2, 2, 3, 4, 4]
+                self.assertEqual(output, answer)
+
+                program = "".join(f"COPY {e:#x} r{i + 8}\n"
+                                                 for i, e in enumerate(consts))
+                program += "COPY 0xdeadbeef r4\nstop\n"
+                computer = machine.Machine(bytearray(get_code(program)))
+                computer.run()
+                output   = [computer.regs[4]] + computer.regs[8:15]
+                answer   = [0xdeadbeef] + [e & 0xffffffff for e in consts]
+                self.assertEqual(output, answer)
+
+                program  = \
+"""
+                COPY data r2
+                LOAD data r6
+                stop
+data:           0xdeadbeef
+"""
+                expander = macros.Expander(short_labels = False)
+                program  = expander.replace(program)
+                self.assertNotIn("copy    data", program)
+                for e in [[], ["-O"]]:
+                        with open("__program__", "w") as f:
+                                f.write(program)
+                        code     = subprocess.check_output(["../assembler",
+                                                  "__program__", "-o", "-", *e],
+                                                  stderr = subprocess.DEVNULL)
+                        os.remove("__program__")
+                        computer = machine.Machine(bytearray(code))
+                        computer.run()
+                        output   = [computer.regs[2], computer.regs[6]]
+                        answer   = [len(code) - 4, 0xdeadbeef]
+                        self.assertEqual(output, answer)
+
         def test_MULT(self):
                 program = \
 """
@@ -2475,21 +3168,44 @@ label:          stop
                 self.assertEqual(output, answer)
 
         def test_label_sys(self):
-                importlib.reload(macros)
+                expander = macros.Expander()
 
-                output = macros.new_label()
-                answer = ["_unique_1"]
+                output   = expander.new_label()
+                answer   = ["_unique_1"]
                 self.assertEqual(output, answer)
 
-                macros.labels.append("_unique_2")
-                output = macros.new_label()
-                answer = ["_unique_3"]
+                expander.labels.add("_unique_2")
+                output   = expander.new_label()
+                answer   = ["_unique_3"]
                 self.assertEqual(output, answer)
 
                 for i in range(4, 101):
-                        macros.new_label()
-                output = macros.labels
-                answer = [f"_unique_{i}" for i in range(1, 101)]
+                        expander.new_label()
+                output   = expander.labels.names
+                answer   = {f"_unique_{i}" for i in range(1, 101)}
+                self.assertEqual(output, answer)
+
+                program  = \
+"""
+_unique_1:      IF r1
+                WHILE r2
+                stop
+                ENDWHILE
+                ENDIF
+"""
+                output   = expander.replace(program)
+                answer   = expander.replace(program)
+                self.assertEqual(output, answer)
+                self.assertIn("_unique_3:", output)
+                self.assertEqual(expander.labels.names,
+                                   {"_unique_1", "_unique_2", "_unique_3",
+                                                              "_unique_4"})
+                self.assertEqual(expander.if_labs + expander.while_labs, [])
+
+                programs = [program.replace("r1", f"r{i}") for i in range(8)]
+                with concurrent.futures.ThreadPoolExecutor(4) as pool:
+                        output = list(pool.map(macros.replace, 20 * programs))
+                answer   = [macros.replace(e) for e in 20 * programs]
                 self.assertEqual(output, answer)
 
         def test_PUSH(self):
@@ -4635,6 +5351,81 @@ code_seg_end:   NOTH
 """.strip()
                 self.assertEqual(output, answer)
 
+        def test_folding(self):
+                for e in ["LSHIFT r8 5 r9", "RSHIFT r8 31 r9", "MOD r8 16 r9",
+                          "MOD r8 10 r9",   "UEXP r8 13 r9",   "UEXP 3 40 r9"]:
+                        output = macros.replace(e)
+                        self.assertNotIn("zjump", output)
+                        self.assertNotIn("store", output)
+
+                program = \
+"""
+                COPY code_seg_end r1
+                ADD  r1           80 r1
+
+                COPY   0xdeadbeef r8
+                LSHIFT r8         5  r9
+                RSHIFT r8         31 r10
+                MOD    r8         16 r11
+                MOD    r8         10 r12
+                UEXP   r8         13 r13
+                UEXP   3          40 r14
+                LSHIFT r8         32 r15
+
+                stop
+
+code_seg_end:   NOTH
+"""
+                computer = machine.Machine(bytearray(get_code(program)))
+                computer.run()
+                output   = computer.regs[9:16]
+                answer   = [0xdeadbeef << 5 & 0xffffffff, 1, 0xf,
+                            0xdeadbeef % 10, pow(0xdeadbeef, 13, 2 ** 32),
+                            pow(3, 40, 2 ** 32), 0]
+                self.assertEqual(output, answer)
+
+        def test_reg_spills(self):
+                asm    = "MOD r8 r9 r10\nXOR r8 r9 r10\nUEXP r8 r9 r10\n"
+                output = macros.replace(asm)
+                self.assertNotIn("store", output)
+                self.assertIn("r15", output)
+                output = macros.Expander(spill_regs = False).replace(asm)
+                self.assertIn("store", output)
+                self.assertNotIn("r15", output)
+
+                program = \
+"""
+                COPY code_seg_end r1
+                ADD  r1           80 r1
+
+                COPY 0xdeadbeef r8
+                COPY 0x1234     r9
+                MOD  r8         r9  r10
+                XOR  r8         r9  r11
+                UEXP r9         r10 r12
+                MOD  r12        r11 r13
+
+                stop
+
+code_seg_end:   NOTH
+"""
+                with open("__program__", "w") as f:
+                        f.write(program)
+                output = []
+                for e in [[], ["--no-reg-spills"]]:
+                        code     = subprocess.check_output(["../assembler",
+                                                   "__program__", "-o", "-", *e])
+                        computer = machine.Machine(bytearray(code))
+                        computer.run()
+                        output.append(computer.regs[8:16])
+                os.remove("__program__")
+                answer = [0xdeadbeef, 0x1234, 0xdeadbeef % 0x1234,
+                          0xdeadbeef ^ 0x1234,
+                          pow(0x1234, 0xdeadbeef % 0x1234, 2 ** 32)]
+                answer.append(answer[-1] % answer[3])
+                answer += [0, 0]
+                self.assertEqual(output, [answer, answer])
+
         def test_ABS(self):
                 program = \
 """